@@ -0,0 +1,355 @@
+"""Benchmark pipeline stages offline with synthetic data and mock APIs."""
+import asyncio
+import contextlib
+import datetime
+import http.server
+import json
+import logging
+import pathlib
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+from types import SimpleNamespace
+
+import h3
+import numpy
+import pandas
+
+import hexarray
+import hexpop
+
+HISTORY_FILE = pathlib.Path(__file__).parent / 'bench_history.jsonl'
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('-n',
+                        '--hexes',
+                        type=int,
+                        default=100000,
+                        help='number of synthetic population hexes')
+    parser.add_argument('-f',
+                        '--fetches',
+                        type=int,
+                        default=1000,
+                        help='number of hexes fetched from mock Mappers')
+    parser.add_argument('-b',
+                        '--boundaries',
+                        type=int,
+                        default=100,
+                        help='number of synthetic boundary polygons')
+    parser.add_argument('-s',
+                        '--stages',
+                        type=str,
+                        nargs='*',
+                        default=None,
+                        help='stages to run, default all, '
+                        'views and hexarray need covermap and coverexp')
+    parser.add_argument('-t',
+                        '--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='slowdown versus median history to report')
+    args = parser.parse_args()
+    return (args.hexes, args.fetches, args.boundaries, args.stages,
+            args.tolerance)
+
+
+def synthetic_kontur(n_hexes, seed=0, origin='8828308281fffff'):
+    """Kontur-like hexes with population, contiguous around origin."""
+    radius = 0
+    while 1 + 3 * radius * (radius + 1) < n_hexes:
+        radius += 1
+    hexes = hexarray.to_ints(h3.k_ring(origin, radius))[:n_hexes]
+    rng = numpy.random.default_rng(seed)
+    return pandas.DataFrame({
+        'h3_index': hexarray.to_strings(numpy.sort(hexes)),
+        'population': rng.lognormal(3, 1.5, hexes.size).astype('int64') + 1
+    })
+
+
+def synthetic_boundaries(df_kontur, n_boundaries):
+    """Grid of rectangular boundary polygons covering synthetic hexes."""
+    import geopandas  # heavy, only for geometry stages
+    import shapely.geometry
+    lat_lng = numpy.array([h3.h3_to_geo(h) for h in df_kontur['h3_index']])
+    (lat0, lng0), (lat1, lng1) = lat_lng.min(axis=0), lat_lng.max(axis=0)
+    side = max(1, int(numpy.ceil(numpy.sqrt(n_boundaries))))
+    lats = numpy.linspace(lat0, lat1 + 1e-9, side + 1)
+    lngs = numpy.linspace(lng0, lng1 + 1e-9, side + 1)
+    boxes = [
+        shapely.geometry.box(lngs[j], lats[i], lngs[j + 1], lats[i + 1])
+        for i in range(side) for j in range(side)
+    ]
+    return geopandas.GeoDataFrame(
+        {
+            'sem_code': [f"S{i // side:03d}" for i in range(len(boxes))],
+            'bis_code': [f"B{i:05d}" for i in range(len(boxes))]
+        },
+        geometry=boxes,
+        crs='epsg:4326')
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """Mock Mappers uplinks and paginated Explorer hotspots."""
+
+    hotspots = []
+    page_size = 1000
+
+    def do_GET(self):
+        """Answer uplinks by hex or hotspots by cursor."""
+        url = urllib.parse.urlparse(self.path)
+        if url.path.startswith('/api/v1/uplinks/hex/'):
+            h3_index = url.path.rsplit('/', 1)[-1]
+            covered = int(h3_index, 16) % 5 == 0  # deterministic 20%
+            payload = {'uplinks': [{'hex': h3_index}] if covered else []}
+        else:
+            cursor = int(
+                urllib.parse.parse_qs(url.query).get('cursor', ['0'])[0])
+            payload = {
+                'data': self.hotspots[cursor:cursor + self.page_size]
+            }
+            if cursor + self.page_size < len(self.hotspots):
+                payload['cursor'] = str(cursor + self.page_size)
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Silence request logging."""
+
+
+def mock_server(hotspots):
+    """Start mock API server on free local port, return base URL."""
+    MockHandler.hotspots = hotspots
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def stage_public(data):
+    """Convert hex polygons to WKT dataframe, as public.py ingests."""
+    import geopandas
+    import shapely.geometry
+    import public
+    gdf = geopandas.GeoDataFrame(
+        {'population': data.kontur['population']},
+        geometry=[
+            shapely.geometry.Polygon(h3.h3_to_geo_boundary(h, geo_json=True))
+            for h in data.kontur['h3_index']
+        ],
+        crs='epsg:4326')
+    return public.gdf2df(gdf).shape[0]
+
+
+def stage_geopop(data):
+    """Assign hex centroids to boundaries, as geopop.ini geo_query does."""
+    import geopandas
+    lat_lng = numpy.array([h3.h3_to_geo(h) for h in data.kontur['h3_index']])
+    centroids = geopandas.GeoDataFrame(
+        data.kontur,
+        geometry=geopandas.points_from_xy(lat_lng[:, 1], lat_lng[:, 0]),
+        crs='epsg:4326')
+    joined = geopandas.sjoin(centroids,
+                             data.boundaries,
+                             predicate='within',
+                             how='inner')
+    data.geopop = pandas.DataFrame(
+        joined[['h3_index', 'sem_code', 'bis_code', 'population']])
+    return data.geopop.shape[0]
+
+
+def stage_covermap(data):
+    """Fetch coverage from mock Mappers API through covermap."""
+    import covermap
+    covermap.MAPPERS_URL = data.base_url + '/api/v1/uplinks/hex/'
+    hexes = data.kontur['h3_index'].iloc[:data.fetches].tolist()
+    output = asyncio.run(covermap.fetch_mappers(hexes))
+    data.mappers = pandas.DataFrame(
+        output, columns=covermap.FETCH_COLUMNS)
+    return len(output)
+
+
+def stage_coverexp(data):
+    """Page through mock Explorer hotspots through coverexp."""
+    import coverexp
+    coverexp.EXPLORER_URL = data.base_url + '/v1/hotspots'
+    pages = list(coverexp.fetch_hotspots())
+    data.explorer = hexarray.HexSet.from_strings(
+        hotspot['location_hex'] for page in pages for hotspot in page)
+    return sum(len(page) for page in pages)
+
+
+@contextlib.contextmanager
+def local_views(data):
+    """Load synthetic tables on temporary DuckDB backend, untimed."""
+    import geopop
+    with tempfile.TemporaryDirectory() as local_path:
+        backend_ini = pathlib.Path(local_path) / 'hexpop.ini'
+        backend_ini.write_text(
+            f"[backend]\nengine: duckdb\npath: {local_path}\n")
+        hexpop.BACKEND_INI, bigquery_ini = backend_ini, hexpop.BACKEND_INI
+        hexpop.backend.cache_clear()
+        try:
+            data.datasets = {
+                name: hexpop.bq_prep_dataset(name)
+                for name in ['public', 'geopop', 'coverage', 'views']
+            }
+            project = data.datasets['views'].project
+            update_time = pandas.Timestamp.now(tz='UTC')
+            usa = geopop.parse_ini('usa')
+            codes = data.boundaries[['sem_code', 'bis_code']]
+            tables = {
+                f"public.{geopop.population_table()}":
+                data.kontur[['h3_index', 'population']],
+                'coverage.explorer_updates':
+                pandas.DataFrame({
+                    'h3_index': data.explorer.to_strings(),
+                    'explorer_coverage': True,
+                    'update_time': update_time
+                }),
+                'coverage.mappers_updates':
+                data.mappers[['h3_index', 'mappers_coverage', 'update_time']],
+                'coverage.mappers_children':
+                data.mappers[[
+                    'h3_index', 'probed_mask', 'covered_mask', 'update_time'
+                ]],
+                # stand-ins for usa sem_source and bis_source, without
+                # geometries which views of usa do not include
+                'geo_us_boundaries.states':
+                pandas.DataFrame({
+                    'state': codes['sem_code'].unique(),
+                    'state_fips_code': codes['sem_code'].unique(),
+                    'state_name': codes['sem_code'].unique()
+                }),
+                'geo_us_boundaries.counties':
+                pandas.DataFrame({
+                    'state_fips_code': codes['sem_code'],
+                    'county_fips_code': codes['bis_code'],
+                    'county_name': codes['bis_code']
+                })
+            }
+            for region in geopop.parse_ini():  # synthetic hexes all in usa
+                tables[f"geopop.{region}"] = data.geopop.rename(
+                    columns={
+                        'sem_code': usa.sem_code,
+                        'bis_code': usa.bis_code
+                    }).head(None if region == 'usa' else 0)
+            for table_id, df in tables.items():
+                hexpop.bq_load_table(df, f"{project}.{table_id}")
+            yield
+        finally:
+            hexpop.BACKEND_INI = bigquery_ini
+            hexpop.backend.cache_clear()
+
+
+def stage_views(data):
+    """Create views, query region statistics and views of synthetic region."""
+    import views
+    datasets = [
+        data.datasets[name] for name in ['geopop', 'coverage', 'views']
+    ]
+    shared = {spec.view_id for spec in views.view_specs(*datasets, [])}
+    rows = 0
+    for spec in views.view_specs(*datasets, ['usa']):
+        hexpop.bq_create_view(spec.dataset, spec.view_id, spec.query)
+        if spec.view_id == 'region_stats' or spec.view_id not in shared:
+            rows += hexpop.bq_query_table(
+                f"SELECT * FROM `{spec.dataset.project}."
+                f"{spec.dataset.dataset_id}.{spec.view_id}`").total_rows
+    return rows
+
+
+def stage_hexarray(data):
+    """Build and combine coverage hex sets."""
+    population = hexarray.HexSet.from_strings(data.kontur['h3_index'])
+    covered = population.intersection(data.explorer).union(
+        hexarray.HexSet.from_strings(data.mappers['h3_index']))
+    return len(population - covered)
+
+
+STAGES = {
+    'public': stage_public,
+    'geopop': stage_geopop,
+    'covermap': stage_covermap,
+    'coverexp': stage_coverexp,
+    'views': stage_views,
+    'hexarray': stage_hexarray
+}
+
+SETUPS = {  # untimed context of stage, such as loading its input tables
+    'views': local_views
+}
+
+
+def git_commit():
+    """Current git commit, if any, to label benchmark results."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True,
+                              cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def regressions(results, tolerance):
+    """Stages slower than median of comparable history by tolerance."""
+    if not HISTORY_FILE.exists():
+        return {}
+    with open(HISTORY_FILE) as history_file:
+        history = [json.loads(line) for line in history_file if line.strip()]
+    history = [h for h in history if h['sizes'] == results['sizes']]
+    slower = {}
+    for stage, seconds in results['seconds'].items():
+        past = [h['seconds'][stage] for h in history if stage in h['seconds']]
+        if past and seconds > (1 + tolerance) * numpy.median(past):
+            slower[stage] = (seconds, float(numpy.median(past)))
+    return slower
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    n_hexes, fetches, n_boundaries, stages, tolerance = parse_args()
+    data = SimpleNamespace(fetches=fetches)
+    data.kontur = synthetic_kontur(n_hexes)
+    data.boundaries = synthetic_boundaries(data.kontur, n_boundaries)
+    data.base_url = mock_server([{
+        'location_hex': h
+    } for h in data.kontur['h3_index'].iloc[::7]])
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'sizes': {
+            'hexes': n_hexes,
+            'fetches': fetches,
+            'boundaries': n_boundaries
+        },
+        'seconds': {},
+        'rows': {}
+    }
+    for stage, function in STAGES.items():
+        if stages and stage not in stages:
+            continue
+        with SETUPS.get(stage, contextlib.nullcontext)(data):
+            time_start = time.perf_counter()
+            rows = function(data)
+            elapsed = time.perf_counter() - time_start
+        results['seconds'][stage] = round(elapsed, 3)
+        results['rows'][stage] = rows
+        logger.info("%-10s %8.3f seconds %10d rows (%.0f rows/sec)", stage,
+                    elapsed, rows, rows / elapsed if elapsed else 0)
+    for stage, (seconds, median) in regressions(results, tolerance).items():
+        logger.warning("%s regressed to %.3f seconds from median %.3f",
+                       stage, seconds, median)
+    with open(HISTORY_FILE, 'a') as history_file:
+        history_file.write(json.dumps(results) + '\n')
@@ -0,0 +1,157 @@
+"""Diff coverage between two points in time: flipped hexes and population."""
+import datetime
+import logging
+import pathlib
+import time
+
+import numpy
+import pandas
+
+import geopop
+import hexarray
+import hexpop
+
+COVERED_AT = """
+SELECT h3_index FROM (
+  SELECT h3_index,
+    ARRAY_AGG(mappers_coverage ORDER BY update_time DESC LIMIT 1)[OFFSET(0)]
+      AS mappers_coverage
+  FROM `{project}.{coverage_dataset}.mappers_updates`
+  WHERE update_time <= TIMESTAMP('{time}')
+  GROUP BY h3_index)
+WHERE mappers_coverage
+UNION DISTINCT
+SELECT h3_index FROM `{project}.{coverage_dataset}.explorer_updates`
+WHERE explorer_coverage AND update_time = (
+  SELECT MAX(update_time)
+  FROM `{project}.{coverage_dataset}.explorer_updates`
+  WHERE update_time <= TIMESTAMP('{time}'))
+"""
+
+GEOPOP_CODES = """
+SELECT h3_index, CAST({sem_code} AS STRING) AS sem_code,
+  CAST({bis_code} AS STRING) AS bis_code, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('before',
+                        type=datetime.datetime.fromisoformat,
+                        help='earlier time, ISO format')
+    parser.add_argument('after',
+                        type=datetime.datetime.fromisoformat,
+                        nargs='?',
+                        default=datetime.datetime.utcnow(),
+                        help='later time, ISO format')
+    parser.add_argument('-r',
+                        '--regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions for which to roll up diff')
+    parser.add_argument('-o',
+                        '--output',
+                        type=pathlib.Path,
+                        default=None,
+                        help='CSV file listing each flipped hex')
+    args = parser.parse_args()
+    return args.before, args.after, args.regions, args.output
+
+
+def covered_at(coverage_dataset, at_time):
+    """Covered hexes as of given time, from update history."""
+    result = hexpop.bq_query_table(
+        COVERED_AT.format(project=coverage_dataset.project,
+                          coverage_dataset=coverage_dataset.dataset_id,
+                          time=at_time.isoformat()))
+    return hexarray.HexSet.from_strings(result.to_dataframe()['h3_index'])
+
+
+def flipped(df_geopop, lost, gained):
+    """Population and codes of region hexes which lost or gained coverage."""
+    hexes = df_geopop['h3_index'].to_numpy()
+    frames = []
+    for change, hex_set in [('lost', lost), ('gained', gained)]:
+        if not hexes.size:
+            break
+        pos = numpy.minimum(numpy.searchsorted(hexes, hex_set.ints),
+                            hexes.size - 1)
+        found = hexes[pos] == hex_set.ints
+        frames.append(df_geopop.iloc[pos[found]].assign(change=change))
+    if not frames:
+        return df_geopop.iloc[:0].assign(change='')
+    return pandas.concat(frames, ignore_index=True)
+
+
+def rollup(df_flipped, level):
+    """Gained and lost hexes and population by code at level."""
+    df = df_flipped.assign(
+        gained=df_flipped['change'] == 'gained',
+        lost=df_flipped['change'] == 'lost')
+    df = df.assign(gained_population=df['population'] * df['gained'],
+                   lost_population=df['population'] * df['lost'])
+    summary = df.groupby(f"{level}_code")[[
+        'gained', 'lost', 'gained_population', 'lost_population'
+    ]].sum().rename(columns={
+        'gained': 'gained_hexes',
+        'lost': 'lost_hexes'
+    })
+    summary['net_population'] = (summary['gained_population'] -
+                                 summary['lost_population'])
+    return summary.rename_axis('code').reset_index().assign(level=level)
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    before, after, regions, output = parse_args()
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    coverage_dataset = hexpop.bq_prep_dataset('coverage')
+    views_dataset = hexpop.bq_prep_dataset('views')
+    covered_before = covered_at(coverage_dataset, before)
+    covered_after = covered_at(coverage_dataset, after)
+    lost, gained = covered_before.compare(covered_after)
+    logger.info("%d covered at %s, %d at %s: lost %d, gained %d hexes",
+                len(covered_before), before, len(covered_after), after,
+                len(lost), len(gained))
+    all_flipped = []
+    for region in hexpop.clean_regions(regions):
+        if region == 'gadm':
+            continue
+        params = geopop.parse_ini(region)
+        df_geopop = hexpop.bq_query_table(
+            GEOPOP_CODES.format(project=regional_dataset.project,
+                                regional_dataset=regional_dataset.dataset_id,
+                                region=region,
+                                sem_code=params.sem_code,
+                                bis_code=params.bis_code)).to_dataframe()
+        df_geopop['h3_index'] = hexarray.to_ints(df_geopop['h3_index'])
+        df_geopop = df_geopop.sort_values('h3_index', ignore_index=True)
+        df_flipped = flipped(df_geopop, lost, gained)
+        df_summary = pandas.concat(
+            [rollup(df_flipped, 'sem'),
+             rollup(df_flipped, 'bis')], ignore_index=True)
+        table_id = '.'.join([
+            views_dataset.project, views_dataset.dataset_id,
+            f"coverage_diff_{region}"
+        ])
+        hexpop.bq_load_table(df_summary, table_id, write='WRITE_TRUNCATE')
+        logger.info("%s gained %d pops in %d hexes, lost %d pops in %d hexes",
+                    region,
+                    df_flipped.loc[df_flipped['change'] == 'gained',
+                                   'population'].sum(),
+                    (df_flipped['change'] == 'gained').sum(),
+                    df_flipped.loc[df_flipped['change'] == 'lost',
+                                   'population'].sum(),
+                    (df_flipped['change'] == 'lost').sum())
+        all_flipped.append(df_flipped.assign(region=region))
+    if output and all_flipped:
+        df_output = pandas.concat(all_flipped, ignore_index=True)
+        df_output['h3_index'] = hexarray.to_strings(df_output['h3_index'])
+        df_output.to_csv(output, index=False)
+    logger.info("completed, %d seconds elapsed",
+                time.perf_counter() - time_start)
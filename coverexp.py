@@ -1,26 +1,25 @@
 """Fetch Explorer hotspot hexes via Helium API."""
 import datetime
+import functools
 import logging
 import pathlib
 import time
 
-import pandas
-import requests
+import numpy
 import tenacity
 
+import hexarray
 import hexpop
 
 EXPLORER_URL = "https://api.helium.io/v1/hotspots"
 
-logger_tenacity = logging.getLogger('tenacity')
-hexpop.initialize_logging(logger_tenacity)
-
 
 @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=1, max=60),
-                before_sleep=tenacity.before_sleep_log(logger_tenacity,
-                                                       logging.WARNING))
+                before_sleep=hexpop.log_retry)
 def helium_api(cursor=''):
     """Helium API query, isolated for tenacity."""
+    import requests
+    hexpop.count('explorer_requests')
     if cursor:
         resp = requests.get(url=EXPLORER_URL + '?cursor=' + cursor)
     else:
@@ -43,7 +42,11 @@ def fetch_hotspots():
         yield payload['data']
 
 
-coverage_dataset = hexpop.bq_prep_dataset('coverage')
+@functools.lru_cache(maxsize=None)
+def coverage_dataset():
+    """Prepare coverage dataset on first use."""
+    return hexpop.bq_prep_dataset('coverage')
+
 
 MOST_RECENT_EXPLORER_UPDATES = """
 SELECT * FROM `{project}.{coverage_dataset}.explorer_updates`
@@ -54,59 +57,90 @@ WHERE update_time >= PARSE_TIMESTAMP('%Y%m%d%H',(
 """
 
 
-def load_explorer_coverage(hex_set):
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.parse_args()
+
+
+def load_explorer_coverage(hex_set, explorer_buffer):
     """Load Explorer coverage hex set to table."""
-    df = pandas.DataFrame({'h3_index': sorted(list(hex_set))})
+    import pandas
+    df = pandas.DataFrame({'h3_index': hex_set.to_strings()})
     df['explorer_coverage'] = True
     df['update_time'] = datetime.datetime.utcnow()
-    hexpop.bq_load_table(df, explorer_table, write='WRITE_APPEND')
+    explorer_buffer.append(df)
+
 
+def query_explorer_coverage(hexset=True, force_new=True):
+    """Query most recent Explorer coverage hex set from view.
 
-def query_explorer_coverage(hexset=True):
-    """Query most recent Explorer coverage hex set from view."""
+    Without force_new, query the existing view rather than recreate it.
+    """
     view_id = 'most_recent_explorer'
+    coverage = coverage_dataset()
     most_recent_explorer = hexpop.bq_create_view(
-        coverage_dataset,
+        coverage,
         view_id,
         MOST_RECENT_EXPLORER_UPDATES.format(
-            project=coverage_dataset.project,
-            coverage_dataset=coverage_dataset.dataset_id),
-        force_new=True)
-    try:
-        df = hexpop.bq_query_table('SELECT * FROM {table}'.format(
-            table=hexpop.bq_full_id(most_recent_explorer))).to_dataframe()
-    except AttributeError:
-        return set(), datetime.datetime.fromtimestamp(0)
+            project=coverage.project, coverage_dataset=coverage.dataset_id),
+        force_new=force_new)
+    query = 'SELECT * FROM {table}'.format(
+        table=hexpop.bq_full_id(most_recent_explorer))
     if not hexset:
-        return df
-    return set(df['h3_index'].loc[df['explorer_coverage']].to_list()), min(
-        df['update_time'])
+        return hexpop.bq_query_table(query).to_dataframe()
+    result = hexpop.bq_query_batches(query)
+    if result is None:
+        return hexarray.HexSet(), datetime.datetime.fromtimestamp(0)
+    covered, earliest = [], []
+    for record_batch in result.batches:  # one batch in pandas at a time
+        df = record_batch.to_pandas()
+        covered.append(
+            hexarray.to_ints(df['h3_index'].loc[df['explorer_coverage']]))
+        earliest.append(df['update_time'].min())
+    if not covered:
+        return hexarray.HexSet(), datetime.datetime.fromtimestamp(0)
+    return hexarray.HexSet(numpy.concatenate(covered)), min(earliest)
 
 
 if __name__ == '__main__':
     logger = logging.getLogger(pathlib.Path(__file__).stem)
     hexpop.initialize_logging(logger)
+    parse_args()
     explorer_schema = hexpop.bq_form_schema([('h3_index', 'STRING'),
                                              ('explorer_coverage', 'BOOLEAN'),
                                              ('update_time', 'TIMESTAMP')])
-    explorer_table = hexpop.bq_create_table(coverage_dataset,
-                                            'explorer_updates',
-                                            schema=explorer_schema,
-                                            partition='update_time',
-                                            partition_hourly=True,
-                                            force_new=False)
+    coverage = coverage_dataset()
+    explorer_table = hexpop.bq_create_table(
+        coverage,
+        'explorer_updates',
+        schema=explorer_schema,
+        partition='update_time',
+        partition_hourly=True,
+        cluster=hexpop.parse_layout(coverage.dataset_id,
+                                    'explorer_updates').cluster,
+        force_new=False)
     time_start = time.perf_counter()
     total_hotspots = 0
-    hex_set = set()
+    pages = []  # uint64 arrays, merged into one HexSet after last page
     for hotspots in fetch_hotspots():
-        total_hotspots += len(hotspots)
-        for hotspot in hotspots:
-            if hotspot['location_hex']:
-                hex_set.add(hotspot['location_hex'])
-        logger.info("%d hotspots covering %d hexes, %d seconds elapsed",
-                    total_hotspots, len(hex_set),
+        with hexpop.stage('fetch') as fetch:
+            total_hotspots += len(hotspots)
+            pages.append(
+                hexarray.to_ints(hotspot['location_hex']
+                                 for hotspot in hotspots
+                                 if hotspot['location_hex']))
+            fetch.rows = len(hotspots)
+        logger.info("%d hotspots, %d seconds elapsed", total_hotspots,
                     time.perf_counter() - time_start)
-    load_explorer_coverage(hex_set)
+    hex_set = hexarray.HexSet(
+        numpy.concatenate(pages) if pages else None)
+    with hexpop.stage('load') as load, hexpop.WriteBuffer(
+            hexpop.bq_full_id(explorer_table),
+            schema=explorer_schema) as explorer_buffer:
+        load_explorer_coverage(hex_set, explorer_buffer)
+        load.rows = len(hex_set)
+    logger.info("write buffer %s", explorer_buffer.metrics())
     logger.info("completed %d hotspots covering %d hexes, %d seconds elapsed",
                 total_hotspots, len(hex_set),
                 time.perf_counter() - time_start)
@@ -1,24 +1,26 @@
 """Fetch H3 hex coverage status based on Mappers uplinks."""
 import asyncio
 import datetime
+import functools
 import itertools
 import logging
 import logging.handlers
-import math
 import pathlib
 import time
 
-import aiohttp
 import h3
 import numpy
-import pandas
 import tenacity
-import token_bucket
 
+import hexarray
 import hexpop
 
 MAPPERS_URL = "https://mappers.helium.com/api/v1/uplinks/hex/"
 # avoid "https://mappers.helium.com/api/v1/coverage/geo/"
+FETCH_COLUMNS = [
+    'h3_index', 'mappers_coverage', 'update_time', 'probed_mask',
+    'covered_mask'
+]
 
 
 def parse_args():
@@ -54,52 +56,105 @@ def parse_args():
                         type=int,
                         default=None,
                         help='refetch coverage status older than EXPIRE days')
+    parser.add_argument('-k',
+                        '--sticky',
+                        type=float,
+                        default=None,
+                        help='refetch only this random fraction of covered '
+                        'hexes due, default all')
+    parser.add_argument('-c',
+                        '--children',
+                        action='store_true',
+                        default=False,
+                        help='record which resolution 9 children were '
+                        'probed and covered')
+    parser.add_argument('-p',
+                        '--probe_all',
+                        action='store_true',
+                        default=False,
+                        help='probe all children, even after one covered, '
+                        'implies --children')
     args = parser.parse_args()
     return (args.regions, args.analyze, args.batch_size, args.rate_limit,
-            args.verbose, args.expire)
+            args.verbose, args.expire, args.sticky,
+            args.children or args.probe_all, args.probe_all)
 
 
-logger_tenacity = logging.getLogger('tenacity')
-hexpop.initialize_logging(logger_tenacity)
+@functools.lru_cache(maxsize=None)
+def limiter(rate_limit):
+    """Token bucket limiting rate of API queries, one per rate."""
+    import token_bucket
+    return token_bucket.Limiter(rate_limit, 60, token_bucket.MemoryStorage())
 
 
 @tenacity.retry(wait=tenacity.wait_exponential(multiplier=1, min=1, max=60),
-                before_sleep=tenacity.before_sleep_log(logger_tenacity,
-                                                       logging.WARNING))
-async def fetch_uplinks(h3_index, session):
-    """Fetch H3 hex coverage based on Mappers uplinks."""
+                before_sleep=hexpop.log_retry)
+async def fetch_uplinks(h3_index, session, rate_limit=0, probe_all=False):
+    """Fetch H3 hex coverage based on Mappers uplinks.
+
+    Masks of resolution 9 children probed and covered have one bit per
+    child, by digit of child index.
+    """
     mappers_coverage = False
-    mapper_urls = [
-        MAPPERS_URL + h for h in h3.k_ring(h3.h3_to_center_child(h3_index))
-    ]
-    for mapper_url in mapper_urls:
-        while rate_limit and not limiter.consume("mappers", 1):
+    probed_mask, covered_mask = 0, 0
+    for child in h3.k_ring(h3.h3_to_center_child(h3_index)):
+        mapper_url = MAPPERS_URL + child
+        child_bit = 1 << (int(child, 16) >> 18 & 7)  # resolution 9 digit
+        while rate_limit and not limiter(rate_limit).consume("mappers", 1):
             time.sleep(0.01)
+        hexpop.count('mappers_requests')
         async with session.get(mapper_url) as response:
             if response.status == 200:
                 uplinks = (await response.json())['uplinks']
+                probed_mask |= child_bit  # answered, unlike status 500
+                if uplinks:
+                    covered_mask |= child_bit
                 mappers_coverage |= len(uplinks) > 0
             elif response.status == 500:
-                logger_tenacity.warning(
+                hexpop.tenacity_logger().warning(
                     "response status 500 for %s, assuming no coverage",
                     mapper_url)
                 mappers_coverage |= False
             else:
                 response.raise_for_status()
-        if mappers_coverage:
+        if mappers_coverage and not probe_all:
             break
-    return [h3_index, mappers_coverage, datetime.datetime.utcnow()]
+    return [
+        h3_index, mappers_coverage,
+        datetime.datetime.utcnow(), probed_mask, covered_mask
+    ]
 
 
-async def fetch_mappers(h3hexes):
+async def fetch_mappers(h3hexes, rate_limit=0, probe_all=False):
     """Queue coroutines to fetch coverage, gather results."""
+    import aiohttp
     async with aiohttp.ClientSession() as session:
-        return await asyncio.gather(
-            *map(fetch_uplinks, h3hexes, itertools.repeat(session)))
+        return await asyncio.gather(*map(fetch_uplinks, h3hexes,
+                                         itertools.repeat(session),
+                                         itertools.repeat(rate_limit),
+                                         itertools.repeat(probe_all)))
+
+
+def fetch_dataframe(h3hexes, rate_limit=0, probe_all=False):
+    """Fetch coverage of hexes into data frame of FETCH_COLUMNS."""
+    import pandas  # heavy, only when fetching
+    loop = asyncio.get_event_loop()
+    loop_output = loop.run_until_complete(
+        fetch_mappers(h3hexes, rate_limit, probe_all))
+    return pandas.DataFrame(loop_output, columns=FETCH_COLUMNS)
+
+
+@functools.lru_cache(maxsize=None)
+def regional_dataset():
+    """Prepare geopop dataset on first use."""
+    return hexpop.bq_prep_dataset('geopop')
 
 
-regional_dataset = hexpop.bq_prep_dataset('geopop')
-coverage_dataset = hexpop.bq_prep_dataset('coverage')
+@functools.lru_cache(maxsize=None)
+def coverage_dataset():
+    """Prepare coverage dataset on first use."""
+    return hexpop.bq_prep_dataset('coverage')
+
 
 ADDITIONS = """
 SELECT h3_index FROM `{project}.{regional_dataset}.{region}`
@@ -107,13 +162,17 @@ WHERE h3_index NOT IN (SELECT h3_index
 FROM `{project}.{coverage_dataset}.mappers_updates`)
 """
 REFRESH = """
-SELECT * FROM
-(SELECT h3_index, MAX(update_time) as update_time
-FROM `{project}.{coverage_dataset}.mappers_updates`
-GROUP BY h3_index
-ORDER BY update_time ASC, h3_index)
-WHERE h3_index IN
-(SELECT h3_index FROM `{project}.{regional_dataset}.{region}`)
+SELECT * FROM (
+  SELECT h3_index, MAX(update_time) AS update_time,
+    ARRAY_AGG(mappers_coverage ORDER BY update_time DESC LIMIT 1)[OFFSET(0)]
+      AS mappers_coverage
+  FROM `{project}.{coverage_dataset}.mappers_updates`
+  WHERE h3_index IN
+  (SELECT h3_index FROM `{project}.{regional_dataset}.{region}`)
+  GROUP BY h3_index)
+WHERE update_time <= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {expire} DAY)
+  AND (NOT mappers_coverage OR RAND() < {sticky})
+ORDER BY update_time ASC, h3_index
 """
 
 MOST_RECENT_MAPPERS_UPDATES = """
@@ -128,105 +187,238 @@ ON
   AND mappers_updates.update_time=most_recent.update_time
 """
 
+MOST_RECENT_MAPPERS_CHILDREN = """
+SELECT mappers_children.*,
+  BIT_COUNT(probed_mask) AS probed_children,
+  BIT_COUNT(covered_mask) AS covered_children,
+  -- only once all children probed, 125 for pentagons lacking digit 1
+  IF(probed_mask IN (125, 127),
+    BIT_COUNT(covered_mask) / BIT_COUNT(probed_mask), NULL)
+    AS children_fraction
+FROM `{project}.{coverage_dataset}.mappers_children` AS mappers_children
+INNER JOIN (
+  SELECT h3_index, MAX(update_time) AS update_time
+  FROM `{project}.{coverage_dataset}.mappers_children`
+  GROUP BY h3_index) AS most_recent
+ON
+  mappers_children.h3_index=most_recent.h3_index
+  AND mappers_children.update_time=most_recent.update_time
+"""
+
+
+def stream_hexes(results, batch_size):
+    """Rebatch H3 indexes with previous coverage, if any, from results."""
+    pending = []
+    for result in results:
+        for record_batch in result.batches:
+            hexes = record_batch.column('h3_index').to_pylist()
+            if 'mappers_coverage' in record_batch.schema.names:
+                previous = record_batch.column('mappers_coverage').to_pylist()
+            else:  # additions, never fetched
+                previous = [None] * len(hexes)
+            pending.extend(zip(hexes, previous))
+            start = 0
+            while len(pending) - start >= batch_size:
+                yield [
+                    list(x)
+                    for x in zip(*pending[start:start + batch_size])
+                ]
+                start += batch_size
+            del pending[:start]  # drop yielded rows once per record batch
+    if pending:
+        yield [list(x) for x in zip(*pending)]
+
+
+def plan_id(region, name):
+    """Full id of table holding planned hexes, read in chunks while fetching.
 
-def load_mappers_coverage(df=None):
-    """Load Mappers coverage data frame to table."""
-    hexpop.bq_load_table(df, mappers_table, write='WRITE_APPEND')
+    Named table rather than anonymous query results, which expire within
+    a day while a large region takes longer.
+    """
+    coverage = coverage_dataset()
+    return '.'.join(
+        [coverage.project, coverage.dataset_id, f"plan_{region}_{name}"])
 
 
-def query_mappers_coverage(hexset=True):
-    """Query most recent Mappers coverage hex set from view."""
+def delete_plan(region):
+    """Delete tables of planned hexes for region."""
+    for name in ['additions', 'refresh']:
+        hexpop.bq_delete_table(plan_id(region, name))
+
+
+def flip_backs(previous, df_output):
+    """Count previously covered hexes re-verified, and those now uncovered."""
+    was_covered = numpy.array([p is True for p in previous])
+    now_covered = df_output['mappers_coverage'].to_numpy(dtype=bool)
+    return int(was_covered.sum()), int((was_covered & ~now_covered).sum())
+
+
+def create_mappers_buffer():
+    """Write buffer for Mappers updates table, created if needed."""
+    coverage = coverage_dataset()
+    mappers_schema = hexpop.bq_form_schema([('h3_index', 'STRING'),
+                                            ('mappers_coverage', 'BOOLEAN'),
+                                            ('update_time', 'TIMESTAMP')])
+    mappers_table = hexpop.bq_create_table(
+        coverage,
+        'mappers_updates',
+        schema=mappers_schema,
+        partition='update_time',
+        cluster=hexpop.parse_layout(coverage.dataset_id,
+                                    'mappers_updates').cluster,
+        force_new=False)
+    return hexpop.WriteBuffer(hexpop.bq_full_id(mappers_table),
+                              schema=mappers_schema)
+
+
+CHILDREN_FIELDS = [('h3_index', 'STRING'), ('probed_mask', 'INTEGER'),
+                   ('covered_mask', 'INTEGER'), ('update_time', 'TIMESTAMP')]
+
+
+def create_children_table():
+    """Create Mappers children table if needed, as views reference it."""
+    coverage = coverage_dataset()
+    return hexpop.bq_create_table(
+        coverage,
+        'mappers_children',
+        schema=hexpop.bq_form_schema(CHILDREN_FIELDS),
+        partition='update_time',
+        cluster=hexpop.parse_layout(coverage.dataset_id,
+                                    'mappers_children').cluster,
+        force_new=False)
+
+
+def create_children_buffer():
+    """Write buffer for Mappers children table, created if needed."""
+    return hexpop.WriteBuffer(hexpop.bq_full_id(create_children_table()),
+                              schema=hexpop.bq_form_schema(CHILDREN_FIELDS))
+
+
+def load_mappers_coverage(df, mappers_buffer, children_buffer=None):
+    """Buffer Mappers coverage data frame for loading to tables."""
+    mappers_buffer.append(df[['h3_index', 'mappers_coverage', 'update_time']])
+    if children_buffer:
+        children_buffer.append(
+            df[['h3_index', 'probed_mask', 'covered_mask', 'update_time']])
+
+
+def query_mappers_coverage(hexset=True, force_new=True):
+    """Query most recent Mappers coverage hex set from view.
+
+    Without force_new, query the existing view rather than recreate it.
+    """
     view_id = 'most_recent_mappers'
+    coverage = coverage_dataset()
     most_recent_mappers = hexpop.bq_create_view(
-        coverage_dataset,
+        coverage,
         view_id,
         MOST_RECENT_MAPPERS_UPDATES.format(
-            project=coverage_dataset.project,
-            coverage_dataset=coverage_dataset.dataset_id),
-        force_new=True)
-    try:
-        df = hexpop.bq_query_table('SELECT * FROM {table}'.format(
-            table=hexpop.bq_full_id(most_recent_mappers))).to_dataframe()
-    except AttributeError:
-        return set(), datetime.datetime.fromtimestamp(0)
+            project=coverage.project, coverage_dataset=coverage.dataset_id),
+        force_new=force_new)
+    query = 'SELECT * FROM {table}'.format(
+        table=hexpop.bq_full_id(most_recent_mappers))
     if not hexset:
-        return df
-    return set(df['h3_index'].loc[df['mappers_coverage']].to_list()), min(
-        df['update_time'])
+        return hexpop.bq_query_table(query).to_dataframe()
+    result = hexpop.bq_query_batches(query)
+    if result is None:
+        return hexarray.HexSet(), datetime.datetime.fromtimestamp(0)
+    covered, earliest = [], []
+    for record_batch in result.batches:  # one batch in pandas at a time
+        df = record_batch.to_pandas()
+        covered.append(
+            hexarray.to_ints(df['h3_index'].loc[df['mappers_coverage']]))
+        earliest.append(df['update_time'].min())
+    if not covered:
+        return hexarray.HexSet(), datetime.datetime.fromtimestamp(0)
+    return hexarray.HexSet(numpy.concatenate(covered)), min(earliest)
 
 
 if __name__ == '__main__':
     logger = logging.getLogger(pathlib.Path(__file__).stem)
     hexpop.initialize_logging(logger)
-    regions, analyze, batch_size, rate_limit, verbose, expire = parse_args()
-    if rate_limit:
-        limiter = token_bucket.Limiter(rate_limit, 60,
-                                       token_bucket.MemoryStorage())
-    mappers_schema = hexpop.bq_form_schema([('h3_index', 'STRING'),
-                                            ('mappers_coverage', 'BOOLEAN'),
-                                            ('update_time', 'TIMESTAMP')])
-    mappers_table = hexpop.bq_create_table(coverage_dataset,
-                                           'mappers_updates',
-                                           schema=mappers_schema,
-                                           partition='update_time',
-                                           force_new=False)
-    for region in hexpop.clean_regions(regions):
-        if region == 'gadm':
-            continue
-        logger = logging.getLogger(' '.join(
-            [pathlib.Path(__file__).stem, region]))
-        hexpop.initialize_logging(logger, verbose)
-        df_additions = hexpop.bq_query_table(
-            ADDITIONS.format(project=coverage_dataset.project,
-                             coverage_dataset=coverage_dataset.dataset_id,
-                             regional_dataset=regional_dataset.dataset_id,
-                             region=region)).to_dataframe()
-        df_refresh = hexpop.bq_query_table(
-            REFRESH.format(project=coverage_dataset.project,
-                           coverage_dataset=coverage_dataset.dataset_id,
-                           table=mappers_table.table_id,
-                           regional_dataset=regional_dataset.dataset_id,
-                           region=region)).to_dataframe()
-        retain = 0
-        if expire:
-            retain = df_refresh.shape[0]
-            expiration_date = datetime.datetime.now().replace(
-                tzinfo=datetime.timezone.utc) - datetime.timedelta(days=expire)
-            df_refresh = df_refresh[(df_refresh['update_time'] <=
-                                     expiration_date)]
-            retain -= df_refresh.shape[0]
-        df_refresh.sort_values(by=['update_time'], inplace=True)
-        try:
-            early = df_refresh['update_time'].iloc[0].strftime('%Y-%m-%dT%X')
-            late = df_refresh['update_time'].iloc[-1].strftime('%Y-%m-%dT%X')
-        except IndexError:
-            early = 'none'
-            late = 'none'
-        df_total = pandas.concat([df_additions,
-                                  df_refresh]).reset_index(drop=True)
-        logger.info("%d hexes (retain %d, add %d, refresh %d from %s to %s)",
-                    df_total.shape[0], retain, df_additions.shape[0],
-                    df_refresh.shape[0], early, late)
-        logger.debug("\n%s", df_total)
-        if analyze or df_total.shape[0] == 0:
-            continue
-        processed = 0
-        time_start = time.perf_counter()
-        for df_batch in numpy.array_split(
-                df_total, math.ceil(df_total.shape[0] / batch_size)):
-            loop = asyncio.get_event_loop()
-            loop_output = loop.run_until_complete(
-                fetch_mappers(df_batch['h3_index'].tolist()))
-            df_output = pandas.DataFrame(
-                loop_output,
-                columns=['h3_index', 'mappers_coverage', 'update_time'])
-            load_mappers_coverage(df_output)
-            processed += df_output.shape[0]
-            proc_pcnt = 100 * processed / df_total.shape[0]
-            elapsed = time.perf_counter() - time_start
-            rate = processed / elapsed
-            message = f"Processed {processed} hexes ({proc_pcnt:.1f}%) \t"
-            message += f"Elapsed {elapsed:.0f} seconds ({rate:.0f} hexes/sec)"
-            logger.info(message)
-        logger.info("completed %s, %d seconds elapsed", region,
-                    time.perf_counter() - time_start)
+    (regions, analyze, batch_size, rate_limit, verbose, expire, sticky,
+     children, probe_all) = parse_args()
+    regional, coverage = regional_dataset(), coverage_dataset()
+    mappers_buffer = create_mappers_buffer()
+    if children:
+        children_buffer = create_children_buffer()
+    else:
+        children_buffer = None
+        create_children_table()  # table exists for views
+    try:
+        for region in hexpop.clean_regions(regions):
+            if region == 'gadm':
+                continue
+            logger = logging.getLogger(' '.join(
+                [pathlib.Path(__file__).stem, region]))
+            hexpop.initialize_logging(logger, verbose)
+            with hexpop.stage('plan') as plan:
+                region_hexes = hexpop.bq_client().get_table('.'.join(
+                    [regional.project, regional.dataset_id, region])).num_rows
+                additions = hexpop.bq_query_chunks(
+                    ADDITIONS.format(project=coverage.project,
+                                     coverage_dataset=coverage.dataset_id,
+                                     regional_dataset=regional.dataset_id,
+                                     region=region),
+                    plan_id(region, 'additions'))
+                refresh = hexpop.bq_query_chunks(
+                    REFRESH.format(project=coverage.project,
+                                   coverage_dataset=coverage.dataset_id,
+                                   regional_dataset=regional.dataset_id,
+                                   region=region,
+                                   expire=expire or 0,
+                                   sticky=1 if sticky is None else sticky),
+                    plan_id(region, 'refresh'))
+                total = additions.total_rows + refresh.total_rows
+                plan.rows = total
+            logger.info("%d hexes (retain %d, add %d, refresh %d older than "
+                        "%d days, sampling %s of covered)", total,
+                        region_hexes - total, additions.total_rows,
+                        refresh.total_rows, expire or 0,
+                        'all' if sticky is None else sticky)
+            if analyze or total == 0:
+                delete_plan(region)
+                continue
+            processed = 0
+            reverified, flipped = 0, 0
+            time_start = time.perf_counter()
+            for h3hexes, previous in stream_hexes([additions, refresh],
+                                                  batch_size):
+                logger.debug("fetching %d hexes from %s", len(h3hexes),
+                             h3hexes[0])
+                with hexpop.stage('fetch') as fetch:
+                    df_output = fetch_dataframe(h3hexes, rate_limit,
+                                                probe_all)
+                    fetch.rows = df_output.shape[0]
+                load_mappers_coverage(df_output, mappers_buffer,
+                                      children_buffer)
+                batch_reverified, batch_flipped = flip_backs(
+                    previous, df_output)
+                reverified += batch_reverified
+                flipped += batch_flipped
+                hexpop.count('mappers_reverified', batch_reverified)
+                hexpop.count('mappers_flip_backs', batch_flipped)
+                processed += df_output.shape[0]
+                proc_pcnt = 100 * processed / total
+                elapsed = time.perf_counter() - time_start
+                rate = processed / elapsed
+                message = f"Processed {processed} hexes ({proc_pcnt:.1f}%) \t"
+                message += (f"Elapsed {elapsed:.0f} seconds "
+                            f"({rate:.0f} hexes/sec)")
+                logger.info(message)
+            delete_plan(region)
+            logger.info("completed %s, %d seconds elapsed", region,
+                        time.perf_counter() - time_start)
+            logger.info("%d of %d re-verified covered hexes flipped back to "
+                        "uncovered (%.2f%%)", flipped, reverified,
+                        100 * flipped / reverified if reverified else 0)
+    finally:  # flush rows fetched so far, even on error or interrupt
+        with hexpop.stage('flush'):
+            try:
+                mappers_buffer.close()
+            finally:
+                if children_buffer:
+                    children_buffer.close()
+    logger.info("write buffer %s", mappers_buffer.metrics())
+    if children_buffer:
+        logger.info("write buffer %s", children_buffer.metrics())
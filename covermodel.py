@@ -0,0 +1,200 @@
+"""Compare coverage models expanding covered hexes by k-ring neighbors."""
+import configparser
+import logging
+import pathlib
+import time
+from types import SimpleNamespace
+
+import numpy
+import pandas
+from h3.api import numpy_int as h3_numpy
+
+import coverexp
+import covermap
+import geopop
+import hexarray
+import hexpop
+
+GEOPOP_BY_LEVEL = """
+SELECT h3_index, CAST({code} AS STRING) AS code, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions for which to compare coverage models')
+    parser.add_argument('-l',
+                        '--level',
+                        type=str,
+                        choices=['sem', 'bis'],
+                        default='sem',
+                        help='subdivision level within region')
+    parser.add_argument('-m',
+                        '--models',
+                        type=str,
+                        nargs='*',
+                        default=None,
+                        help='coverage models from .ini file, default all')
+    args = parser.parse_args()
+    return args.regions, args.level, args.models
+
+
+def parse_ini(models=None):
+    """Parse coverage models from .ini file."""
+    ini = configparser.ConfigParser()
+    ini.read(pathlib.Path(__file__).with_suffix('.ini'))
+    params = []
+    for model in models or ini.sections():
+        params.append(
+            SimpleNamespace(name=model,
+                            weights={
+                                source: [
+                                    float(w) for w in ini.get(
+                                        model, f"{source}_weights").split(',')
+                                ]
+                                for source in ['explorer', 'mappers']
+                            }))
+    return params
+
+
+def ring_index(h3_ints, radius, chunk_size=100000):
+    """Neighbors of each hex within radius, columns ordered by distance.
+
+    Ring holds int32 positions into sorted unique neighbors rather than
+    uint64 indexes, neighbor 0 padding where pentagons have fewer.
+    """
+    distances = numpy.concatenate(
+        [numpy.full(max(1, 6 * d), d) for d in range(radius + 1)])
+    starts = numpy.flatnonzero(numpy.diff(distances, prepend=-1))
+    chunks = []
+    for chunk_start in range(0, h3_ints.size, chunk_size):
+        chunk_ints = h3_ints[chunk_start:chunk_start + chunk_size]
+        chunk = numpy.zeros((chunk_ints.size, distances.size),
+                            dtype=numpy.uint64)
+        for row, h3_int in enumerate(chunk_ints.tolist()):
+            ring_sets = h3_numpy.k_ring_distances(h3_int, radius)
+            if sum(r.size for r in ring_sets) == distances.size:
+                chunk[row] = numpy.concatenate(
+                    [numpy.sort(r) for r in ring_sets])
+                continue
+            for ring_set, col in zip(ring_sets, starts):  # pentagon
+                chunk[row, col:col + ring_set.size] = numpy.sort(ring_set)
+        unique, inverse = numpy.unique(chunk, return_inverse=True)
+        chunks.append((unique, inverse.reshape(chunk.shape)))
+    neighbors = numpy.unique(
+        numpy.concatenate([numpy.zeros(1, dtype=numpy.uint64)] +
+                          [unique for unique, _ in chunks]))
+    ring = numpy.concatenate(
+        [numpy.zeros((0, distances.size), dtype=numpy.int32)] + [
+            numpy.searchsorted(neighbors, unique).astype(
+                numpy.int32)[inverse] for unique, inverse in chunks
+        ])
+    return ring, neighbors, distances
+
+
+def cached_ring_index(name, h3_ints, radius):
+    """Load ring index from cache if computed for same hexes, else compute."""
+    cache_path = hexpop.CACHE_DIR / f"ring_{name}_k{radius}.npz"
+    if cache_path.exists():
+        with numpy.load(cache_path) as cached:
+            if ('neighbors' in cached.files
+                    and numpy.array_equal(cached['hexes'], h3_ints)):
+                return cached['ring'], cached['neighbors'], cached[
+                    'distances']
+    ring, neighbors, distances = ring_index(h3_ints, radius)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    numpy.savez(cache_path,
+                hexes=h3_ints,
+                ring=ring,
+                neighbors=neighbors,
+                distances=distances)
+    return ring, neighbors, distances
+
+
+def model_fractions(ring, neighbors, distances, hex_sets, models):
+    """Fraction of each hex covered under each model, in a single pass."""
+    covered = {
+        source: hex_set.contains(neighbors)[ring]
+        for source, hex_set in hex_sets.items()
+    }
+    fractions = {}
+    for model in models:
+        fraction = numpy.zeros(ring.shape[0])
+        for source, weights in model.weights.items():
+            for d, weight in enumerate(weights):
+                hit = covered[source][:, distances == d].any(axis=1)
+                fraction = numpy.maximum(fraction, weight * hit)
+        fractions[model.name] = fraction
+    return fractions
+
+
+def summarize(df_geopop, fractions):
+    """Total population covered by subdivision for each model."""
+    summary = []
+    for name, fraction in fractions.items():
+        df = df_geopop.assign(covered=df_geopop['population'] * fraction)
+        by_code = df.groupby('code')[['covered', 'population']].sum()
+        by_code.loc['total'] = by_code.sum()
+        summary.append(by_code.reset_index().assign(model=name))
+    summary = pandas.concat(summary, ignore_index=True).rename(
+        columns={'population': 'total'})
+    summary['covered'] = summary['covered'].round().astype('int64')
+    summary['total'] = summary['total'].astype('int64')
+    summary['percent'] = (100 * summary['covered'] / summary['total']).round(1)
+    return summary[['model', 'code', 'covered', 'total', 'percent']]
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    regions, level, model_names = parse_args()
+    models = parse_ini(model_names)
+    radius = max(
+        len(weights) - 1 for model in models
+        for weights in model.weights.values())
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    views_dataset = hexpop.bq_prep_dataset('views')
+    hex_sets = {
+        'explorer': coverexp.query_explorer_coverage()[0],
+        'mappers': covermap.query_mappers_coverage()[0]
+    }
+    logger.info("%d explorer and %d mappers covered hexes, models %s",
+                len(hex_sets['explorer']), len(hex_sets['mappers']),
+                ', '.join(model.name for model in models))
+    for region in hexpop.clean_regions(regions):
+        if region == 'gadm':
+            continue
+        params = geopop.parse_ini(region)
+        df_geopop = hexpop.bq_query_table(
+            GEOPOP_BY_LEVEL.format(
+                project=regional_dataset.project,
+                regional_dataset=regional_dataset.dataset_id,
+                region=region,
+                code=getattr(params, f"{level}_code"))).to_dataframe()
+        df_geopop['h3_index'] = hexarray.to_ints(df_geopop['h3_index'])
+        df_geopop = df_geopop.sort_values('h3_index', ignore_index=True)
+        ring, neighbors, distances = cached_ring_index(
+            region, df_geopop['h3_index'].to_numpy(), radius)
+        logger.info("%s ring index %d hexes within radius %d, %s bytes",
+                    region, ring.shape[0], radius,
+                    ring.nbytes + neighbors.nbytes)
+        df_summary = summarize(
+            df_geopop,
+            model_fractions(ring, neighbors, distances, hex_sets, models))
+        table_id = '.'.join([
+            views_dataset.project, views_dataset.dataset_id,
+            f"coverage_models_{region}"
+        ])
+        hexpop.bq_load_table(df_summary, table_id, write='WRITE_TRUNCATE')
+        for row in df_summary[df_summary['code'] == 'total'].itertuples():
+            logger.info("%s %s %.1f%% covered", region, row.model,
+                        row.percent)
+    logger.info("completed, %d seconds elapsed",
+                time.perf_counter() - time_start)
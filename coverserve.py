@@ -0,0 +1,295 @@
+"""Serve coverage queries over HTTP from in-memory H3 indexes."""
+import http.server
+import json
+import logging
+import pathlib
+import threading
+import time
+import urllib.parse
+from types import SimpleNamespace
+
+import h3
+import numpy
+
+import coverexp
+import covermap
+import geopop
+import hexarray
+import hexpop
+
+GEOPOP_CODES = """
+SELECT h3_index, CAST({sem_code} AS STRING) AS sem_code,
+  CAST({bis_code} AS STRING) AS bis_code, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions to load into memory')
+    parser.add_argument('-a',
+                        '--address',
+                        type=str,
+                        default='127.0.0.1',
+                        help='address on which to listen')
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        default=8080,
+                        help='port on which to listen')
+    parser.add_argument('-r',
+                        '--reload',
+                        type=int,
+                        default=300,
+                        help='seconds between checks for new coverage')
+    args = parser.parse_args()
+    return args.regions, args.address, args.port, args.reload
+
+
+def load_region(region, regional_dataset):
+    """Load region hexes sorted by index, with code-sorted positions."""
+    params = geopop.parse_ini(region)
+    df = hexpop.bq_query_table(
+        GEOPOP_CODES.format(project=regional_dataset.project,
+                            regional_dataset=regional_dataset.dataset_id,
+                            region=region,
+                            sem_code=params.sem_code,
+                            bis_code=params.bis_code)).to_dataframe()
+    df['h3_index'] = hexarray.to_ints(df['h3_index'])
+    df = df.sort_values('h3_index', ignore_index=True)
+    index = SimpleNamespace(name=region,
+                            hexes=df['h3_index'].to_numpy(),
+                            population=df['population'].to_numpy(),
+                            covered=numpy.zeros(df.shape[0], dtype=bool))
+    for level in ['sem', 'bis']:
+        codes = df[f"{level}_code"].fillna('').to_numpy(dtype=str)
+        order = numpy.argsort(codes, kind='stable')
+        setattr(index, f"{level}_codes", codes)
+        setattr(index, f"{level}_order", order)
+        setattr(index, f"{level}_sorted", codes[order])
+    return index
+
+
+def lookup(regions, h3_ints):
+    """Locate hexes within loaded regions, as (region, positions) pairs."""
+    found = []
+    for index in regions.values():
+        if not index.hexes.size:
+            continue
+        pos = numpy.minimum(numpy.searchsorted(index.hexes, h3_ints),
+                            index.hexes.size - 1)
+        match = index.hexes[pos] == h3_ints
+        if match.any():
+            found.append((index, pos[match]))
+    return found
+
+
+def summarize(found, uncovered=False):
+    """Population and coverage of hexes located within regions."""
+    population = sum(int(index.population[pos].sum()) for index, pos in found)
+    covered = sum(
+        int(index.population[pos][index.covered[pos]].sum())
+        for index, pos in found)
+    summary = {
+        'hexes': sum(pos.size for _, pos in found),
+        'population': population,
+        'covered_population': covered,
+        'percent': round(100 * covered / population, 1) if population else None
+    }
+    if uncovered:
+        summary['uncovered'] = [
+            h for index, pos in found for h in hexarray.to_strings(
+                index.hexes[pos][~index.covered[pos]])
+        ]
+    return summary
+
+
+class CoverageState:
+    """Region indexes with coverage, swapped whole on reload."""
+
+    def __init__(self, regions, regional_dataset):
+        self.regions = {
+            region: load_region(region, regional_dataset)
+            for region in regions
+        }
+        self.modified = None
+        self.loaded = None
+
+    def coverage_modified(self):
+        """Latest modification time of coverage update tables."""
+        client = hexpop.bq_client()
+        return max(
+            client.get_table('.'.join(
+                [client.project, 'coverage', table_id])).modified
+            for table_id in ['explorer_updates', 'mappers_updates'])
+
+    def reload(self, force=False):
+        """Reload coverage if update tables modified since last load."""
+        modified = self.coverage_modified()
+        if not force and modified == self.modified:
+            return False
+        explorer = coverexp.query_explorer_coverage(force_new=False)[0]
+        mappers = covermap.query_mappers_coverage(force_new=False)[0]
+        regions = {}
+        for name, index in self.regions.items():
+            regions[name] = SimpleNamespace(**vars(index))
+            regions[name].covered = (explorer.contains(index.hexes)
+                                     | mappers.contains(index.hexes))
+        self.regions = regions  # readers keep previous until swapped
+        self.modified = modified
+        self.loaded = time.time()
+        return True
+
+    def hex_query(self, h3_index):
+        """Coverage of single hex."""
+        found = lookup(self.regions, hexarray.to_ints([h3_index]))
+        if not found:
+            return None
+        index, pos = found[0]
+        return {
+            'h3_index': h3_index,
+            'region': index.name,
+            'sem_code': index.sem_codes[pos[0]],
+            'bis_code': index.bis_codes[pos[0]],
+            'population': int(index.population[pos[0]]),
+            'covered': bool(index.covered[pos[0]])
+        }
+
+    def admin_query(self, region, code, uncovered=False):
+        """Coverage of administrative division by sem_code or bis_code."""
+        index = self.regions.get(region)
+        if index is None:
+            return None
+        for level in ['sem', 'bis']:
+            codes = getattr(index, f"{level}_sorted")
+            start = numpy.searchsorted(codes, code, side='left')
+            stop = numpy.searchsorted(codes, code, side='right')
+            if stop > start:
+                pos = getattr(index, f"{level}_order")[start:stop]
+                return {
+                    'region': region,
+                    'level': level,
+                    'code': code,
+                    **summarize([(index, pos)], uncovered)
+                }
+        return None
+
+    def polygon_query(self, geometry, uncovered=False):
+        """Coverage of hexes with centroids inside GeoJSON polygon."""
+        if geometry.get('type') == 'Feature':
+            geometry = geometry['geometry']
+        polygons = geometry['coordinates']
+        if geometry['type'] == 'Polygon':
+            polygons = [polygons]
+        hexes = set()
+        for coordinates in polygons:
+            polygon = {'type': 'Polygon', 'coordinates': coordinates}
+            hexes |= h3.polyfill(polygon, 8, geo_json_conformant=True)
+        found = lookup(self.regions, hexarray.HexSet.from_strings(hexes).ints)
+        return summarize(found, uncovered)
+
+
+class CoverageHandler(http.server.BaseHTTPRequestHandler):
+    """Route GET /hex/, GET /admin/, POST /polygon, GET /status."""
+
+    state = None
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Answer hex, admin, or status query."""
+        url = urllib.parse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        uncovered = 'uncovered' in urllib.parse.parse_qs(url.query)
+        if parts == ['status']:
+            payload = {
+                'regions': {
+                    name: int(index.hexes.size)
+                    for name, index in self.state.regions.items()
+                },
+                'coverage_modified': str(self.state.modified),
+                'loaded': self.state.loaded
+            }
+        elif len(parts) == 2 and parts[0] == 'hex':
+            try:
+                valid = h3.h3_is_valid(parts[1])
+            except (OverflowError, ValueError):  # beyond 64 bits, or sign
+                valid = False
+            if not valid:
+                self._reply({'error': f"invalid H3 index {parts[1]}"},
+                            status=400)
+                return
+            payload = self.state.hex_query(parts[1])
+        elif len(parts) == 3 and parts[0] == 'admin':
+            payload = self.state.admin_query(parts[1], parts[2], uncovered)
+        else:
+            payload = None
+        if payload is None:
+            self._reply({'error': 'not found'}, status=404)
+        else:
+            self._reply(payload)
+
+    def do_POST(self):
+        """Answer polygon query with GeoJSON body."""
+        url = urllib.parse.urlparse(self.path)
+        if url.path.rstrip('/') != '/polygon':
+            self._reply({'error': 'not found'}, status=404)
+            return
+        uncovered = 'uncovered' in urllib.parse.parse_qs(url.query)
+        try:
+            geometry = json.loads(
+                self.rfile.read(int(self.headers['Content-Length'])))
+            if not isinstance(geometry, dict):
+                raise ValueError('body must be GeoJSON object')
+            self._reply(self.state.polygon_query(geometry, uncovered))
+        except (KeyError, TypeError, ValueError) as err:
+            self._reply({'error': str(err)}, status=400)
+
+    def log_message(self, *args):
+        """Log requests at debug level rather than to stderr."""
+        logging.getLogger(pathlib.Path(__file__).stem).debug(*args)
+
+
+def reload_forever(state, interval):
+    """Check for new coverage periodically, reload when modified."""
+    while True:
+        time.sleep(interval)
+        try:
+            if state.reload():
+                logger.info("reloaded coverage modified %s", state.modified)
+        except Exception as err:  # keep serving previous coverage
+            logger.error("EXCEPTION while reloading: %s", err)
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    regions, address, port, interval = parse_args()
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    CoverageHandler.state = CoverageState(
+        [r for r in hexpop.clean_regions(regions) if r != 'gadm'],
+        regional_dataset)
+    CoverageHandler.state.reload(force=True)
+    logger.info("loaded %d hexes across %d regions, %d seconds elapsed",
+                sum(index.hexes.size
+                    for index in CoverageHandler.state.regions.values()),
+                len(CoverageHandler.state.regions),
+                time.perf_counter() - time_start)
+    threading.Thread(target=reload_forever,
+                     args=(CoverageHandler.state, interval),
+                     daemon=True).start()
+    server = http.server.ThreadingHTTPServer((address, port), CoverageHandler)
+    logger.info("serving on %s:%d", address, port)
+    server.serve_forever()
@@ -0,0 +1,255 @@
+"""Estimate coverage percentage by population-weighted stratified sampling."""
+import asyncio
+import datetime
+import logging
+import math
+import pathlib
+import statistics
+import time
+from types import SimpleNamespace
+
+import numpy
+import pandas
+
+import coverexp
+import covermap
+import geopop
+import hexarray
+import hexpop
+
+GEOPOP_SEM = """
+SELECT h3_index, CAST({sem_code} AS STRING) AS sem_code, population
+FROM `{project}.{regional_dataset}.{region}`
+WHERE population > 0
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions for which to estimate coverage')
+    parser.add_argument('-p',
+                        '--precision',
+                        type=float,
+                        default=0.5,
+                        help='target half-width of confidence interval, '
+                        'percentage points')
+    parser.add_argument('-c',
+                        '--confidence',
+                        type=float,
+                        default=0.95,
+                        help='confidence level of intervals')
+    parser.add_argument('-n',
+                        '--initial',
+                        type=int,
+                        default=1000,
+                        help='number of draws in first round')
+    parser.add_argument('-m',
+                        '--max_draws',
+                        type=int,
+                        default=20000,
+                        help='maximum number of draws per region')
+    parser.add_argument('-b',
+                        '--batch_size',
+                        type=int,
+                        default=1000,
+                        help='number per batch of fetches')
+    parser.add_argument('-r',
+                        '--rate_limit',
+                        type=int,
+                        default=0,
+                        help='rate per second of API queries')
+    parser.add_argument('-s',
+                        '--seed',
+                        type=int,
+                        default=None,
+                        help='seed for random draws')
+    args = parser.parse_args()
+    return (args.regions, args.precision / 100, args.confidence, args.initial,
+            args.max_draws, args.batch_size, args.rate_limit, args.seed)
+
+
+def form_strata(df):
+    """Hexes, cumulative population and population share by sem_code."""
+    strata = {}
+    for code, df_code in df.groupby('sem_code'):
+        population = df_code['population'].to_numpy(dtype=float)
+        strata[code] = SimpleNamespace(hexes=df_code['h3_index'].to_numpy(),
+                                       cumulative=numpy.cumsum(population),
+                                       population=population.sum(),
+                                       draws=[])
+    total = sum(s.population for s in strata.values())
+    for stratum in strata.values():
+        stratum.weight = stratum.population / total
+    return strata
+
+
+def draw(stratum, n_draws, rng):
+    """Draw hexes with probability proportional to population, replaced."""
+    return stratum.hexes[numpy.searchsorted(
+        stratum.cumulative,
+        rng.uniform(0, stratum.cumulative[-1], n_draws),
+        side='right')]
+
+
+def smoothed(stratum):
+    """Covered fraction of draws, shrunk away from 0 and 1 for variance."""
+    return (sum(stratum.draws) + 0.5) / (len(stratum.draws) + 1)
+
+
+def allocate(strata, n_total):
+    """Neyman allocation of total draws by population share and spread."""
+    scores = {
+        code: s.weight * math.sqrt(smoothed(s) * (1 - smoothed(s)))
+        for code, s in strata.items()
+    }
+    total = sum(scores.values())
+    return {
+        code: max(0, round(n_total * score / total) - len(strata[code].draws))
+        for code, score in scores.items()
+    }
+
+
+def required_draws(strata, half_width, z_score):
+    """Total draws for half-width under Neyman allocation."""
+    spread = sum(s.weight * math.sqrt(smoothed(s) * (1 - smoothed(s)))
+                 for s in strata.values())
+    return math.ceil((spread * z_score / half_width)**2)
+
+
+def wilson(covered, draws, z_score):
+    """Wilson score interval of covered fraction."""
+    if not draws:
+        return 0.0, 1.0
+    fraction = covered / draws
+    center = (fraction + z_score**2 / (2 * draws)) / (1 + z_score**2 / draws)
+    margin = z_score * math.sqrt(fraction * (1 - fraction) / draws + z_score**2
+                                 / (4 * draws**2)) / (1 + z_score**2 / draws)
+    return center - margin, center + margin
+
+
+def estimate(strata, z_score):
+    """Stratified covered fraction and half-width of confidence interval."""
+    fraction = sum(s.weight * numpy.mean(s.draws) for s in strata.values())
+    variance = sum(s.weight**2 * smoothed(s) * (1 - smoothed(s)) /
+                   len(s.draws) for s in strata.values())
+    return fraction, z_score * math.sqrt(variance)
+
+
+def survey(hexes, known, explorer, mappers_buffer, batch_size, rate_limit):
+    """Coverage of drawn hexes, fetching only those unknown and uncovered."""
+    unknown = [h for h in dict.fromkeys(hexes) if h not in known]
+    in_explorer = explorer.contains(hexarray.to_ints(unknown))
+    for h3_index in numpy.array(unknown, dtype=object)[in_explorer]:
+        known[h3_index] = True  # covered without API requests
+    to_fetch = [h for h, e in zip(unknown, in_explorer) if not e]
+    for start in range(0, len(to_fetch), batch_size):
+        output = asyncio.run(
+            covermap.fetch_mappers(to_fetch[start:start + batch_size],
+                                   rate_limit))
+        df_output = pandas.DataFrame(
+            output, columns=covermap.FETCH_COLUMNS)
+        covermap.load_mappers_coverage(df_output, mappers_buffer)
+        known.update(zip(df_output['h3_index'], df_output['mappers_coverage']))
+    hexpop.count('estimate_fetched', len(to_fetch))
+    return [known[h] for h in hexes]
+
+
+def summarize(strata, z_score):
+    """Estimate, interval, and draws for each subdivision and total."""
+    rows = []
+    for code, stratum in strata.items():
+        covered, draws = sum(stratum.draws), len(stratum.draws)
+        low, high = wilson(covered, draws, z_score)
+        rows.append({
+            'code': code,
+            'population': int(stratum.population),
+            'draws': draws,
+            'covered_draws': covered,
+            'percent': round(100 * covered / draws, 2) if draws else None,
+            'ci_low': round(100 * low, 2),
+            'ci_high': round(100 * high, 2)
+        })
+    fraction, half_width = estimate(strata, z_score)
+    rows.append({
+        'code': 'total',
+        'population': int(sum(s.population for s in strata.values())),
+        'draws': sum(r['draws'] for r in rows),
+        'covered_draws': sum(r['covered_draws'] for r in rows),
+        'percent': round(100 * fraction, 2),
+        'ci_low': round(100 * max(0.0, fraction - half_width), 2),
+        'ci_high': round(100 * min(1.0, fraction + half_width), 2)
+    })
+    return pandas.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    (regions, precision, confidence, initial, max_draws, batch_size,
+     rate_limit, seed) = parse_args()
+    z_score = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    rng = numpy.random.default_rng(seed)
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    views_dataset = hexpop.bq_prep_dataset('views')
+    explorer = coverexp.query_explorer_coverage()[0]
+    with covermap.create_mappers_buffer() as mappers_buffer:
+        known = {}  # coverage of hexes surveyed this run
+        for region in hexpop.clean_regions(regions):
+            if region == 'gadm':
+                continue
+            time_start = time.perf_counter()
+            params = geopop.parse_ini(region)
+            strata = form_strata(
+                hexpop.bq_query_table(
+                    GEOPOP_SEM.format(
+                        project=regional_dataset.project,
+                        regional_dataset=regional_dataset.dataset_id,
+                        region=region,
+                        sem_code=params.sem_code)).to_dataframe())
+            allocation = {  # proportional first round, two draws at least
+                code: max(2, round(initial * s.weight))
+                for code, s in strata.items()
+            }
+            rounds = 0
+            while True:
+                rounds += 1
+                for code, n_draws in allocation.items():
+                    hexes = draw(strata[code], n_draws, rng)
+                    strata[code].draws += survey(hexes, known, explorer,
+                                                 mappers_buffer, batch_size,
+                                                 rate_limit)
+                fraction, half_width = estimate(strata, z_score)
+                draws = sum(len(s.draws) for s in strata.values())
+                logger.info("%s round %d, %d draws: %.2f%% +/- %.2f%%", region,
+                            rounds, draws, 100 * fraction, 100 * half_width)
+                if half_width <= precision or draws >= max_draws:
+                    break
+                target = min(
+                    max(required_draws(strata, precision, z_score),
+                        draws + len(strata)), max_draws)
+                allocation = allocate(strata, target)
+                if not sum(allocation.values()):  # lost to rounding
+                    neediest = max(
+                        strata,
+                        key=lambda c: strata[c].weight / len(strata[c].draws))
+                    allocation = {neediest: 1}
+            df_summary = summarize(strata, z_score)
+            df_summary['confidence'] = confidence
+            df_summary['estimate_time'] = datetime.datetime.utcnow()
+            table_id = '.'.join(
+                [views_dataset.project, views_dataset.dataset_id,
+                 f"estimate_{region}"])
+            hexpop.bq_load_table(df_summary, table_id, write='WRITE_TRUNCATE')
+            logger.info(
+                "%s coverage %.2f%% (%.0f%% interval %.2f%% to %.2f%%) from "
+                "%d draws, %d seconds elapsed", region,
+                df_summary['percent'].iloc[-1], 100 * confidence,
+                df_summary['ci_low'].iloc[-1], df_summary['ci_high'].iloc[-1],
+                draws,
+                time.perf_counter() - time_start)
+    logger.info("write buffer %s", mappers_buffer.metrics())
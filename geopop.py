@@ -16,8 +16,21 @@ def parse_args():
                         nargs='*',
                         type=str,
                         help='global region to load into geopop table')
+    parser.add_argument('-d',
+                        '--dry_run',
+                        action='store_true',
+                        default=False,
+                        help='estimate bytes each geo_query would scan, '
+                        'do not create tables')
     args = parser.parse_args()
-    return args.regions
+    return args.regions, args.dry_run
+
+
+def population_table():
+    """Table of current population release, from .ini file defaults."""
+    ini = configparser.ConfigParser()
+    ini.read(pathlib.Path(__file__).with_suffix('.ini'))
+    return ini.defaults()['population']
 
 
 def parse_ini(region=None):
@@ -28,7 +41,9 @@ def parse_ini(region=None):
     ini.read(pathlib.Path(__file__).with_suffix('.ini'))
     if not region:
         return ini.sections()
-    params = SimpleNamespace()
+    params = SimpleNamespace(population=ini.get(region,
+                                                'population',
+                                                fallback=None))
     try:
         params.geo_query = ini.get(region, 'geo_query')
     except (configparser.NoSectionError, configparser.NoOptionError):
@@ -56,15 +71,40 @@ if __name__ == '__main__':
     logger = logging.getLogger(main_name)
     hexpop.initialize_logging(logger)
     dataset = hexpop.bq_prep_dataset(main_name)
-    regions = parse_args()
+    regions, dry_run = parse_args()
     if not regions:
         regions = parse_ini()
     for region in hexpop.clean_regions(regions):
-        geo_query = parse_ini(region).geo_query
-        logger.info("creating %s table for %s", main_name, region)
-        table = hexpop.bq_create_table(dataset, region, force_new=True)
-        result = hexpop.bq_query_table(
-            geo_query.format(project=dataset.project),
-            hexpop.bq_full_id(table))
+        params = parse_ini(region)
+        if dry_run:
+            logger.info(
+                "geo_query for %s would scan %.3f GB", region,
+                hexpop.bq_estimate_query(
+                    params.geo_query.format(project=dataset.project,
+                                            population=params.population)) /
+                10**9)
+            continue
+        layout = hexpop.parse_layout(
+            dataset.dataset_id,
+            region,
+            region_codes=[
+                getattr(params, code) for code in ['sem_code', 'bis_code']
+                if hasattr(params, code)
+            ])
+        logger.info("creating %s table for %s clustered by %s", main_name,
+                    region, layout.cluster)
+        query = params.geo_query.format(project=dataset.project,
+                                        population=params.population)
+        table = hexpop.bq_create_table(  # clustered table needs schema
+            dataset,
+            region,
+            schema=hexpop.bq_query_schema(query),
+            cluster=layout.cluster,
+            force_new=True)
+        with hexpop.stage('geo_query') as geo_query:
+            result = hexpop.bq_query_table(query,
+                                           hexpop.bq_full_id(table),
+                                           cluster=layout.cluster)
+            geo_query.rows = result.total_rows
         logger.info("created table %s with %d rows", table.full_table_id,
                     result.total_rows)
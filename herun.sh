@@ -41,6 +41,14 @@ coverage() {
   python3 covermap.py -x $expire # fetch coverage status for each hex by region
 }
 
+layout() {
+  python3 layout.py -c  # cluster and partition tables, compare bytes scanned
+}
+
+pipeline() {
+  python3 pipeline.py "$@"  # public, geopop and views concurrently by dependency
+}
+
 views() {
   python3 views.py  # create dynamic views of population coverage by region
 }
@@ -60,12 +68,18 @@ case "$1" in
   coverage)
     coverage $2
     ;;
+  layout)
+    layout
+    ;;
   views)
     views
     ;;
+  pipeline)
+    pipeline "${@:2}"
+    ;;
   regions)
     regions $2
     ;;
   *)
-    echo "Usage: $0 {public|geopop|coverage|views|regions}"
+    echo "Usage: $0 {public|geopop|coverage|layout|views|pipeline|regions}"
 esac
@@ -0,0 +1,138 @@
+"""Compact H3 hex sets as sorted uint64 arrays, strings only for I/O."""
+import numpy
+
+H3_RES_OFFSET = 52
+H3_RES_MASK = numpy.uint64(0xF << H3_RES_OFFSET)
+H3_BASE_CELL_OFFSET = 45
+H3_DIGIT_BITS = 3
+H3_MAX_RES = 15
+
+
+def to_ints(h3_strings):
+    """Convert H3 index strings to uint64 array."""
+    h3_strings = list(h3_strings)
+    if not h3_strings:
+        return numpy.empty(0, dtype=numpy.uint64)
+    joined = '0' + '0'.join(h3_strings)  # pad each 15-char index to 16
+    if len(joined) == 16 * len(h3_strings):
+        return numpy.frombuffer(bytes.fromhex(joined),
+                                dtype='>u8').astype(numpy.uint64)
+    return numpy.fromiter((int(h, 16) for h in h3_strings),
+                          dtype=numpy.uint64,
+                          count=len(h3_strings))
+
+
+def to_strings(h3_ints):
+    """Convert uint64 array to list of H3 index strings."""
+    h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+    if not h3_ints.size:
+        return []
+    padded = numpy.frombuffer(
+        h3_ints.astype('>u8').tobytes().hex().encode(), dtype='S16')
+    return numpy.char.lstrip(padded.astype('U16'), '0').tolist()
+
+
+def get_resolution(h3_ints):
+    """Resolution of each H3 index in uint64 array."""
+    h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+    return ((h3_ints & H3_RES_MASK) >> numpy.uint64(H3_RES_OFFSET)).astype(
+        numpy.int8)
+
+
+def get_base_cell(h3_ints):
+    """Resolution 0 base cell of each H3 index in uint64 array."""
+    h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+    return ((h3_ints >> numpy.uint64(H3_BASE_CELL_OFFSET)) &
+            numpy.uint64(0x7F)).astype(numpy.int16)
+
+
+def to_parent(h3_ints, res):
+    """Parent at coarser resolution of each H3 index in uint64 array."""
+    h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+    unused_digits = numpy.uint64((1 << (H3_DIGIT_BITS *
+                                        (H3_MAX_RES - res))) - 1)
+    return ((h3_ints & ~H3_RES_MASK)
+            | numpy.uint64(res << H3_RES_OFFSET)) | unused_digits
+
+
+class HexSet:
+    """Set of H3 indexes stored as sorted unique uint64 array."""
+
+    __slots__ = ('ints', )
+
+    def __init__(self, h3_ints=None, is_sorted=False):
+        if h3_ints is None:
+            h3_ints = numpy.empty(0, dtype=numpy.uint64)
+        h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+        self.ints = h3_ints if is_sorted else numpy.unique(h3_ints)
+
+    @classmethod
+    def from_strings(cls, h3_strings):
+        """Create set from H3 index strings."""
+        return cls(to_ints(h3_strings))
+
+    def to_strings(self):
+        """List H3 index strings in sorted order."""
+        return to_strings(self.ints)
+
+    def contains(self, h3_ints):
+        """Vectorized membership of uint64 array in set."""
+        h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+        if not self.ints.size:
+            return numpy.zeros(h3_ints.shape, dtype=bool)
+        pos = numpy.minimum(numpy.searchsorted(self.ints, h3_ints),
+                            self.ints.size - 1)
+        return self.ints[pos] == h3_ints
+
+    def union(self, other):
+        """Union of two sets, merging sorted runs in linear time."""
+        merged = numpy.concatenate([self.ints, other.ints])
+        merged.sort(kind='stable')  # timsort merges the two sorted runs
+        keep = numpy.ones(merged.size, dtype=bool)
+        keep[1:] = merged[1:] != merged[:-1]
+        return HexSet(merged[keep], is_sorted=True)
+
+    def intersection(self, other):
+        """Intersection of two sets, searching smaller within larger."""
+        small, large = sorted([self, other], key=len)
+        return HexSet(small.ints[large.contains(small.ints)], is_sorted=True)
+
+    def difference(self, other):
+        """Members of this set not in other set."""
+        return HexSet(self.ints[~other.contains(self.ints)], is_sorted=True)
+
+    def compare(self, other):
+        """Members only in this set, and only in other, in one merge pass."""
+        merged = numpy.concatenate([self.ints, other.ints])
+        order = numpy.argsort(merged, kind='stable')  # merges sorted runs
+        merged = merged[order]
+        paired = numpy.zeros(merged.size, dtype=bool)
+        paired[1:] = merged[1:] == merged[:-1]
+        paired[:-1] |= paired[1:]
+        from_self = order < self.ints.size
+        return (HexSet(merged[~paired & from_self], is_sorted=True),
+                HexSet(merged[~paired & ~from_self], is_sorted=True))
+
+    def __contains__(self, h3_index):
+        if isinstance(h3_index, str):
+            h3_index = int(h3_index, 16)
+        return bool(self.contains(numpy.uint64(h3_index)))
+
+    def __len__(self):
+        return self.ints.size
+
+    def __eq__(self, other):
+        return (isinstance(other, HexSet)
+                and numpy.array_equal(self.ints, other.ints))
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __repr__(self):
+        return f"HexSet({len(self)} hexes, {self.ints.nbytes} bytes)"
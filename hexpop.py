@@ -1,22 +1,48 @@
 """Functions for hex population analysis with BigQuery."""
 import argparse
+import atexit
+import configparser
+import contextlib
+import cProfile
+import fnmatch
+import functools
+import hashlib
+import json
 import logging
 import logging.handlers
+import multiprocessing.util
 import os
 import pathlib
 import platform
+import pstats
+import queue
 import sys
+import threading
 import time
+from types import SimpleNamespace
 
-from google.api_core.exceptions import Conflict, NotFound
-from google.cloud import bigquery
-from google.oauth2 import service_account
+import tenacity
+
+# pandas and requests imported where used, google-cloud-bigquery on first
+# use through _google(), keeping import light
 
 LOG_DIR = '/var/log/hexpop'
+LAYOUT_INI = pathlib.Path(__file__).parent / 'layout.ini'
+BACKEND_INI = pathlib.Path(__file__).parent / 'hexpop.ini'
+CACHE_DIR = pathlib.Path(__file__).parent / 'cache'
+JOB_STATS = []  # statistics of BigQuery jobs completed by this process
+LOGGING = SimpleNamespace(pid=None, listener=None, handler=None, verbose={})
+PROFILE = SimpleNamespace(profiler=None,
+                          logger=None,
+                          path=None,
+                          stages={},
+                          counters={},
+                          dumps=[],
+                          lock=threading.Lock())
 
 
-def initialize_logging(logger, verbose=False):
-    """Initialize logger with console, file, and syslog handlers."""
+def _start_logging():
+    """Start queue listener with console, file, and syslog handlers."""
     if 'linux' in platform.platform().lower():
         syslog_path = '/dev/log'
     elif 'macos' in platform.platform().lower():
@@ -24,18 +50,12 @@ def initialize_logging(logger, verbose=False):
     else:
         syslog_path = '/dev/null'
 
-    logger.handlers = []  # clean slate
-    logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter(
         '%(asctime)s.%(msecs)03d %(name)s: %(message)s',
         datefmt='%Y-%m-%dT%H:%M:%S')
     _ch = logging.StreamHandler()
-    if verbose:
-        _ch.setLevel(logging.DEBUG)
-    else:
-        _ch.setLevel(logging.INFO)
+    _ch.setLevel(logging.DEBUG)  # logger level decides if verbose
     _ch.setFormatter(formatter)
-    logger.addHandler(_ch)
     os.makedirs(LOG_DIR, exist_ok=True)
     _fh = logging.handlers.RotatingFileHandler(
         pathlib.Path(LOG_DIR) / pathlib.Path(
@@ -44,19 +64,213 @@ def initialize_logging(logger, verbose=False):
         backupCount=5)
     _fh.setLevel(logging.INFO)
     _fh.setFormatter(formatter)
-    logger.addHandler(_fh)
     _sh = logging.handlers.SysLogHandler(address=syslog_path)
     _sh.setLevel(logging.WARN)
     _sh.setFormatter(logging.Formatter('%(name)s: %(message)s'))
-    logger.addHandler(_sh)
+    log_queue = queue.SimpleQueue()
+    LOGGING.listener = logging.handlers.QueueListener(
+        log_queue, _ch, _fh, _sh, respect_handler_level=True)
+    LOGGING.listener.start()
+    LOGGING.handler = logging.handlers.QueueHandler(log_queue)
+    if LOGGING.pid is None:
+        atexit.register(_stop_logging)
+    else:  # forked child, such as multiprocessing worker, skips atexit
+        multiprocessing.util.Finalize(None, _stop_logging, exitpriority=10)
+        for name in LOGGING.verbose:  # replace handler bound to parent
+            logging.getLogger(name).handlers = [LOGGING.handler]
+    LOGGING.pid = os.getpid()
+
+
+def _stop_logging():
+    """Drain queued records and stop listener of this process."""
+    if LOGGING.listener is not None and LOGGING.pid == os.getpid():
+        LOGGING.listener.stop()
+        LOGGING.listener = None
+
+
+def initialize_logging(logger, verbose=False):
+    """Initialize logger, sharing handlers configured once per process."""
+    if LOGGING.pid != os.getpid():
+        _start_logging()
+    if LOGGING.verbose.get(logger.name) == verbose:
+        return  # already initialized
+    logger.handlers = [LOGGING.handler]
+    logger.propagate = False  # no duplicates via initialized ancestors
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+    LOGGING.verbose[logger.name] = verbose
     logger.debug("logger initialized")
 
 
+class _ProfileParser(argparse.ArgumentParser):
+    """Argument parser which initializes profiling once arguments parsed."""
+
+    def parse_args(self, args=None, namespace=None):
+        parsed = super().parse_args(args, namespace)
+        initialize_profiling(parsed.profile)
+        return parsed
+
+
 def initialize_parser(docstring):
     """Initialize parser with help showing docstring and defaults."""
-    return argparse.ArgumentParser(
+    parser = _ProfileParser(
         description=docstring,
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='write cProfile statistics to log directory')
+    return parser
+
+
+def initialize_profiling(enable=False):
+    """Register stage summary at exit, start cProfile if enabled."""
+    if PROFILE.logger is None:  # __main__ may be torn down by exit
+        PROFILE.logger = logging.getLogger(f"{__name__}.profile_summary")
+        initialize_logging(PROFILE.logger)
+        PROFILE.path = pathlib.Path(LOG_DIR) / pathlib.Path(
+            sys.modules['__main__'].__file__).with_suffix('.prof').name
+        atexit.register(profile_summary)
+    if enable and PROFILE.profiler is None:
+        PROFILE.profiler = cProfile.Profile()
+        PROFILE.profiler.enable()
+
+
+def worker_profile_path():
+    """Path for pool workers to dump cProfile statistics, None if disabled."""
+    return PROFILE.path if PROFILE.profiler is not None else None
+
+
+def initialize_worker_profiling(path=None):
+    """Reset stage timers inherited by pool worker, start cProfile if path."""
+    if PROFILE.profiler is not None:  # forked from profiling parent
+        PROFILE.profiler.disable()
+    PROFILE.profiler = cProfile.Profile() if path else None
+    PROFILE.path = pathlib.Path(path) if path else None
+    PROFILE.stages, PROFILE.counters, PROFILE.dumps = {}, {}, []
+    PROFILE.lock = threading.Lock()
+    JOB_STATS.clear()
+
+
+def profiled_task(func):
+    """Decorate pool task to return its result with worker profile.
+
+    Stage timers, counters, and BigQuery job totals accumulated by the task
+    are handed back for merge_worker_profile in the parent, and cProfile
+    statistics dumped per task for profile_summary to merge.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILE.profiler is not None:
+            PROFILE.profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            if PROFILE.profiler is not None:
+                PROFILE.profiler.disable()
+        with PROFILE.lock:
+            worker = SimpleNamespace(stages=PROFILE.stages,
+                                     counters=PROFILE.counters,
+                                     job_stats=list(JOB_STATS),
+                                     dump=None)
+            PROFILE.stages, PROFILE.counters = {}, {}
+            JOB_STATS.clear()
+        if PROFILE.profiler is not None:
+            worker.dump = PROFILE.path.with_suffix(
+                f".{os.getpid()}_{len(PROFILE.dumps)}.prof")
+            PROFILE.profiler.dump_stats(worker.dump)
+            PROFILE.dumps.append(worker.dump)
+            PROFILE.profiler = cProfile.Profile()
+        return result, worker
+
+    return wrapper
+
+
+def merge_worker_profile(worker):
+    """Merge profile returned by profiled_task into this process."""
+    with PROFILE.lock:
+        for name, totals in worker.stages.items():
+            merged = PROFILE.stages.setdefault(name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'rows': 0
+            })
+            for key, value in totals.items():
+                merged[key] += value
+        for name, value in worker.counters.items():
+            PROFILE.counters[name] = PROFILE.counters.get(name, 0) + value
+        JOB_STATS.extend(worker.job_stats)
+        if worker.dump is not None:
+            PROFILE.dumps.append(worker.dump)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time named stage, accumulating calls, seconds, and rows."""
+    record = SimpleNamespace(rows=0)
+    time_start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        elapsed = time.perf_counter() - time_start
+        with PROFILE.lock:
+            totals = PROFILE.stages.setdefault(name, {
+                'calls': 0,
+                'seconds': 0.0,
+                'rows': 0
+            })
+            totals['calls'] += 1
+            totals['seconds'] += elapsed
+            totals['rows'] += record.rows
+
+
+def count(name, value=1):
+    """Increment named counter, such as API round trips."""
+    with PROFILE.lock:
+        PROFILE.counters[name] = PROFILE.counters.get(name, 0) + value
+
+
+def profile_summary():
+    """Log stage timers, counters, and BigQuery job totals, dump cProfile."""
+    logger = PROFILE.logger
+    if PROFILE.profiler is not None:
+        PROFILE.profiler.disable()
+        stats = pstats.Stats(PROFILE.profiler)
+        for dump in PROFILE.dumps:  # per task of pool workers
+            stats.add(str(dump))
+            dump.unlink()
+        stats.dump_stats(PROFILE.path)
+        logger.info("cProfile statistics written to %s, merging %d tasks",
+                    PROFILE.path, len(PROFILE.dumps))
+    if not (PROFILE.stages or PROFILE.counters or JOB_STATS):
+        return
+    stages = {}
+    for name, totals in PROFILE.stages.items():
+        stages[name] = dict(totals, seconds=round(totals['seconds'], 3))
+        if totals['rows'] and totals['seconds']:
+            stages[name]['rows_per_sec'] = round(totals['rows'] /
+                                                 totals['seconds'])
+    summary = {
+        'stages': stages,
+        'counters': PROFILE.counters,
+        'bq_jobs': len(JOB_STATS)
+    }
+    for key in ['wall_ms', 'slot_ms', 'bytes_billed']:
+        summary[f"bq_{key}"] = sum(s[key] or 0 for s in JOB_STATS)
+    logger.info(json.dumps(summary))
+
+
+@functools.lru_cache(maxsize=None)
+def tenacity_logger():
+    """Logger for tenacity retries, initialized on first retry."""
+    logger = logging.getLogger('tenacity')
+    initialize_logging(logger)
+    return logger
+
+
+def log_retry(retry_state):
+    """Log tenacity retry as warning, for use as before_sleep."""
+    tenacity.before_sleep_log(tenacity_logger(), logging.WARNING)(retry_state)
 
 
 def clean_regions(regions):
@@ -78,14 +292,171 @@ def clean_regions(regions):
     return regions
 
 
+def parse_layout(dataset_id, table_id=None, region_codes=None):
+    """Parse physical layout of table from .ini file, else its dataset."""
+    layout = SimpleNamespace(cluster=None,
+                             range_column=None,
+                             range_expression=None,
+                             partition_range=None)
+    ini = configparser.ConfigParser()
+    ini.read(LAYOUT_INI)
+    section = '.'.join([dataset_id, table_id]) if table_id else dataset_id
+    if not ini.has_section(section):  # pattern, as for population releases
+        section = next(
+            (s for s in ini.sections() if fnmatch.fnmatchcase(section, s)),
+            dataset_id)
+    if not ini.has_section(section):
+        return layout
+    if ini.has_option(section, 'cluster'):
+        layout.cluster = [
+            c.strip() for c in ini.get(section, 'cluster').split(',')
+        ]
+    if region_codes and ini.getboolean(
+            section, 'cluster_region_codes', fallback=False):
+        layout.cluster = (layout.cluster or []) + [
+            c for c in region_codes if c not in (layout.cluster or [])
+        ]
+    if layout.cluster:
+        layout.cluster = layout.cluster[:4]  # BigQuery clustering maximum
+    if ini.has_option(section, 'range_partition'):
+        layout.range_column = ini.get(section, 'range_column')
+        layout.range_expression = ini.get(section,
+                                          'range_expression',
+                                          fallback=None)
+        start, end, interval = [
+            int(x) for x in ini.get(section, 'range_partition').split(',')
+        ]
+        layout.partition_range = (layout.range_column, start, end, interval)
+    return layout
+
+
+def cached_source(url, timeout=60):
+    """Download source to cache, only if changed upstream since cached.
+
+    Conditional GET on stored ETag and Last-Modified, returning cached path,
+    SHA-256 of content, and whether content changed since previous run.
+    """
+    import requests
+    logger = logging.getLogger(f"{__name__}.{sys._getframe().f_code.co_name}")
+    initialize_logging(logger)
+    source_dir = CACHE_DIR / 'sources'
+    source_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()[:12]
+    path = source_dir / f"{key}_{url.rstrip('/').rsplit('/', 1)[-1]}"
+    meta_path = path.with_name(path.name + '.json')
+    meta = {}
+    if path.exists() and meta_path.exists():
+        meta = json.loads(meta_path.read_text())
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        response = requests.get(url,
+                                headers=headers,
+                                stream=True,
+                                timeout=timeout)
+    except requests.ConnectionError as err:
+        if not meta:
+            raise
+        logger.warning("%s unreachable, using cached copy: %s", url, err)
+        return SimpleNamespace(path=path, sha256=meta['sha256'], changed=False)
+    with response:
+        if response.status_code == 304:
+            count('source_not_modified')
+            logger.info("%s not modified, cached as %s", url, path)
+            return SimpleNamespace(path=path,
+                                   sha256=meta['sha256'],
+                                   changed=False)
+        response.raise_for_status()
+        digest = hashlib.sha256()
+        partial = path.with_name(path.name + '.part')
+        with open(partial, 'wb') as partial_file:
+            for chunk in response.iter_content(chunk_size=2**20):
+                digest.update(chunk)
+                partial_file.write(chunk)
+        os.replace(partial, path)  # whole file or none
+    count('source_downloads')
+    sha256 = digest.hexdigest()
+    meta_path.write_text(
+        json.dumps({
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': sha256
+        }))
+    logger.info("%s downloaded to %s, %d bytes", url, path,
+                path.stat().st_size)
+    return SimpleNamespace(path=path,
+                           sha256=sha256,
+                           changed=sha256 != meta.get('sha256'))
+
+
+@functools.lru_cache(maxsize=None)
+def backend():
+    """Parse backend for bq_* functions, BigQuery or local DuckDB."""
+    ini = configparser.ConfigParser()
+    ini.read(BACKEND_INI)
+    return SimpleNamespace(
+        engine=ini.get('backend', 'engine', fallback='bigquery'),
+        path=pathlib.Path(__file__).parent /
+        ini.get('backend', 'path', fallback='local'),
+        project=ini.get('backend', 'project', fallback='local'))
+
+
+def _local(function):
+    """Run bq_* function on local backend instead, if configured."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if backend().engine == 'duckdb':
+            import localbq
+            return getattr(localbq, function.__name__[3:])(*args, **kwargs)
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def _google():
+    """Google Cloud modules, imported once on first use."""
+    from google.api_core import exceptions
+    from google.cloud import bigquery
+    from google.oauth2 import service_account
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:  # optional, reads fall back to paged REST
+        bigquery_storage = None
+    return SimpleNamespace(bigquery=bigquery,
+                           bigquery_storage=bigquery_storage,
+                           exceptions=exceptions,
+                           service_account=service_account)
+
+
+def _credentials():
+    """Service account credentials shared by BigQuery clients."""
+    return _google().service_account.Credentials.from_service_account_file(
+        pathlib.Path(__file__).parent / 'google-service-account.json')
+
+
 # https://cloud.google.com/bigquery/docs/quickstarts/quickstart-client-libraries
+@_local
 def bq_client():
     """Set up client for Google BigQuery API requests."""
-    credentials = service_account.Credentials.from_service_account_file(
-        pathlib.Path(__file__).parent / 'google-service-account.json')
-    return bigquery.Client(credentials=credentials)
+    return _google().bigquery.Client(credentials=_credentials())
 
 
+@_local
+def bq_storage_client():
+    """Set up client for BigQuery Storage reads, None if not installed."""
+    if _google().bigquery_storage is None:
+        return None
+    return _google().bigquery_storage.BigQueryReadClient(
+        credentials=_credentials())
+
+
+@_local
 def bq_prep_dataset(dataset_name, list_tables=False, test_dataset=False):
     """Check that BigQuery project and dataset are ready."""
     logger = logging.getLogger(f"{__name__}.{sys._getframe().f_code.co_name}")
@@ -97,9 +468,9 @@ def bq_prep_dataset(dataset_name, list_tables=False, test_dataset=False):
     dataset_id = f'{client.project}.{dataset_name}'
     try:
         dataset = client.get_dataset(dataset_id)
-    except NotFound:
+    except _google().exceptions.NotFound:
         logger.warning("bq dataset %s not found, creating", dataset_id)
-        dataset = bigquery.Dataset(dataset_id)
+        dataset = _google().bigquery.Dataset(dataset_id)
         dataset.location = 'US'
         dataset = client.create_dataset(dataset)
     logger.info("bq dataset %s ready", dataset.full_dataset_id)
@@ -111,20 +482,27 @@ def bq_prep_dataset(dataset_name, list_tables=False, test_dataset=False):
     return dataset
 
 
+@_local
 def bq_form_schema(fields):
     """Convert list of (name, field_type) tuples into BigQuery schema."""
-    return [bigquery.SchemaField(x[0].strip(), x[1].strip()) for x in fields]
+    return [
+        _google().bigquery.SchemaField(x[0].strip(), x[1].strip())
+        for x in fields
+    ]
 
 
+@_local
 def bq_create_table(dataset,
                     table_id,
                     schema=None,
                     partition=None,
                     partition_hourly=False,
+                    partition_range=None,
                     cluster=None,
                     description=None,
                     force_new=False):
     """Create BigQuery table, forcefully if required."""
+    bigquery = _google().bigquery
     client = bq_client()
     table_id = '.'.join([dataset.project, dataset.dataset_id, table_id])
     if force_new:
@@ -137,57 +515,294 @@ def bq_create_table(dataset,
             table.time_partitioning.type_ = bigquery.TimePartitioningType.HOUR
         else:
             table.time_partitioning.type_ = bigquery.TimePartitioningType.DAY
+    if partition_range:  # (field, start, end, interval) on integer column
+        field, start, end, interval = partition_range
+        table.range_partitioning = bigquery.RangePartitioning(
+            field=field,
+            range_=bigquery.PartitionRange(start=start,
+                                           end=end,
+                                           interval=interval))
     if cluster:
         table.clustering_fields = cluster
     if description:
         table.description = description
     try:
         return client.create_table(table)
-    except Conflict:
+    except _google().exceptions.Conflict:
         return client.get_table(table)
 
 
+@_local
 def bq_create_view(dataset, view_id, view_query, force_new=False):
     """Create BigQuery view forcefully if required."""
     client = bq_client()
     view_id = '.'.join([dataset.project, dataset.dataset_id, view_id])
     if force_new:
         client.delete_table(view_id, not_found_ok=True)  # clean slate
-    view = bigquery.Table(view_id)
+    view = _google().bigquery.Table(view_id)
     view.view_query = view_query
     try:
         return client.create_table(view)
-    except Conflict:
+    except _google().exceptions.Conflict:
         return client.get_table(view)
 
 
+def bq_job_stats(job, time_start):
+    """Record statistics of completed BigQuery job as structured log."""
+    logger = logging.getLogger(f"{__name__}.{sys._getframe().f_code.co_name}")
+    initialize_logging(logger)
+    stats = {
+        'job_id': job.job_id,
+        'job_type': job.job_type,
+        'wall_ms': round(1000 * (time.perf_counter() - time_start)),
+        'slot_ms': getattr(job, 'slot_millis', None),
+        'bytes_processed': getattr(job, 'total_bytes_processed', None),
+        'bytes_billed': getattr(job, 'total_bytes_billed', None),
+        'cache_hit': getattr(job, 'cache_hit', None),
+        'output_rows': getattr(job, 'output_rows', None),
+        'destination': str(job.destination) if job.destination else None
+    }
+    JOB_STATS.append(stats)
+    logger.info(json.dumps(stats))
+    return stats
+
+
+@_local
+def bq_estimate_query(query):
+    """Estimate bytes BigQuery query would scan, using dry run."""
+    client = bq_client()
+    job_config = _google().bigquery.QueryJobConfig(dry_run=True,
+                                                   use_query_cache=False)
+    job = client.query(query=query, job_config=job_config)
+    return job.total_bytes_processed
+
+
+@_local
+def bq_query_schema(query):
+    """Schema of BigQuery query results, using dry run."""
+    client = bq_client()
+    job_config = _google().bigquery.QueryJobConfig(dry_run=True,
+                                                   use_query_cache=False)
+    job = client.query(query=query, job_config=job_config)
+    return job.schema
+
+
+@_local
 def bq_load_table(df, table_id, schema=None, write='WRITE_APPEND'):
     """Load Pandas dataframe into BigQuery table."""
     client = bq_client()
-    job_config = bigquery.LoadJobConfig(
+    job_config = _google().bigquery.LoadJobConfig(
         schema=schema,
         write_disposition=write  # default append existing
     )
+    time_start = time.perf_counter()
     job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
     result = job.result()  # wait for job to complete
+    bq_job_stats(job, time_start)
     return result
 
 
-def bq_query_table(query, destination=None, write='WRITE_APPEND'):
+class WriteBuffer:
+    """Coalesce dataframes for BigQuery table, load in background thread.
+
+    Flush when buffered rows or bytes reach threshold, else periodically.
+    """
+
+    def __init__(self,
+                 table_id,
+                 schema=None,
+                 max_rows=10000,
+                 max_bytes=10**8,
+                 max_seconds=60,
+                 attempts=5):
+        self.table_id = table_id
+        self.schema = schema
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.attempts = attempts
+        self.flush_seconds = []  # latency of each flush
+        self.flushed_rows = 0
+        self._frames = []
+        self._rows = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._logger = logging.getLogger(f"{__name__}.WriteBuffer")
+        initialize_logging(self._logger)
+        self._thread = threading.Thread(target=self._run,
+                                        name=f"WriteBuffer {table_id}",
+                                        daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, df):
+        """Buffer dataframe, waking flush thread if threshold reached."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"append to closed buffer {self.table_id}")
+            self._frames.append(df)
+            self._rows += df.shape[0]
+            self._bytes += int(df.memory_usage(deep=True).sum())
+            full = self._rows >= self.max_rows or self._bytes >= self.max_bytes
+        if full:
+            self._wake.set()
+
+    def close(self):
+        """Flush remaining rows and stop flush thread.
+
+        Rows still unflushed are saved to cache directory, then reported.
+        """
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+        self._thread.join()
+        if not self._frames:
+            return
+        import pandas
+        df = pandas.concat(self._frames, ignore_index=True)
+        unflushed_path = (CACHE_DIR / 'unflushed' /
+                          f"{bq_tmp_id(self.table_id)}.pkl")
+        unflushed_path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_pickle(unflushed_path)
+        raise RuntimeError(f"{df.shape[0]} rows not flushed to "
+                           f"{self.table_id}, saved to {unflushed_path}")
+
+    def metrics(self):
+        """Summarize flush count, rows, and latency."""
+        latency = self.flush_seconds or [0]
+        return {
+            'table_id': self.table_id,
+            'flushes': len(self.flush_seconds),
+            'rows': self.flushed_rows,
+            'pending_rows': self._rows,
+            'mean_flush_seconds': round(sum(latency) / len(latency), 3),
+            'max_flush_seconds': round(max(latency), 3)
+        }
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.max_seconds)
+            self._wake.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            frames, self._frames = self._frames, []
+            self._rows, self._bytes = 0, 0
+        if not frames:
+            return
+        import pandas
+        df = pandas.concat(frames, ignore_index=True)
+        time_start = time.perf_counter()
+        try:
+            for attempt in tenacity.Retrying(
+                    stop=tenacity.stop_after_attempt(self.attempts),
+                    wait=tenacity.wait_exponential(multiplier=1, max=60),
+                    before_sleep=tenacity.before_sleep_log(
+                        self._logger, logging.WARNING),
+                    reraise=True):
+                with attempt:
+                    bq_load_table(df, self.table_id, schema=self.schema)
+        except Exception as err:  # keep rows for next flush
+            self._logger.error("flush of %d rows to %s failed: %s",
+                               df.shape[0], self.table_id, err)
+            with self._lock:
+                self._frames.insert(0, df)
+                self._rows += df.shape[0]
+                self._bytes += int(df.memory_usage(deep=True).sum())
+            return
+        self.flush_seconds.append(time.perf_counter() - time_start)
+        self.flushed_rows += df.shape[0]
+        self._logger.debug("flushed %d rows to %s in %.1f seconds",
+                           df.shape[0], self.table_id,
+                           self.flush_seconds[-1])
+
+
+@_local
+def bq_query_table(query,
+                   destination=None,
+                   write='WRITE_APPEND',
+                   cluster=None):
     """Query BigQuery table using SQL."""
     client = bq_client()
-    job_config = bigquery.QueryJobConfig(
+    job_config = _google().bigquery.QueryJobConfig(
         destination=destination,
         write_disposition=write  # default append existing
     )
+    if destination and cluster:  # must match clustered destination table
+        job_config.clustering_fields = cluster
+    time_start = time.perf_counter()
     job = client.query(query=query, job_config=job_config)
     try:
         result = job.result()  # wait for job to complete
-    except NotFound:
+    except _google().exceptions.NotFound:
+        return None
+    bq_job_stats(job, time_start)
+    return result
+
+
+@_local
+def bq_query_batches(query, page_size=None):
+    """Query BigQuery table using SQL, stream results as Arrow batches.
+
+    Returns total_rows and lazy iterator of record batches, read via the
+    Storage API when installed, so callers can start on the first batch.
+    """
+    client = bq_client()
+    time_start = time.perf_counter()
+    job = client.query(query=query)
+    try:
+        result = job.result(page_size=page_size)  # wait for job to complete
+    except _google().exceptions.NotFound:
+        return None
+    bq_job_stats(job, time_start)
+    return SimpleNamespace(total_rows=result.total_rows,
+                           batches=result.to_arrow_iterable(
+                               bqstorage_client=bq_storage_client()))
+
+
+@_local
+def bq_query_chunks(query, destination, chunk_rows=100000):
+    """Query BigQuery into named table, stream results in chunks.
+
+    Each chunk opens a fresh read of the destination table, so consumers
+    taking days outlive neither read sessions nor anonymous result tables.
+    """
+    result = bq_query_table(query, destination, write='WRITE_TRUNCATE')
+    if result is None:
         return None
+
+    def batches():
+        client = bq_client()
+        for start_index in range(0, result.total_rows, chunk_rows):
+            yield from client.list_rows(
+                destination, start_index=start_index,
+                max_results=chunk_rows).to_arrow_iterable()
+
+    return SimpleNamespace(total_rows=result.total_rows, batches=batches())
+
+
+@_local
+def bq_copy_table(source_id, destination_id, write='WRITE_EMPTY'):
+    """Copy BigQuery table, creating destination with source layout."""
+    client = bq_client()
+    job_config = _google().bigquery.CopyJobConfig(write_disposition=write)
+    time_start = time.perf_counter()
+    job = client.copy_table(source_id, destination_id, job_config=job_config)
+    result = job.result()  # wait for job to complete
+    bq_job_stats(job, time_start)
     return result
 
 
+@_local
 def bq_delete_table(table_id):
     """Delete BigQuery table, if present."""
     client = bq_client()
@@ -0,0 +1,193 @@
+"""Rewrite BigQuery tables in place with clustering and partitioning."""
+import configparser
+import fnmatch
+import logging
+import pathlib
+from types import SimpleNamespace
+
+from google.cloud import bigquery
+
+import geopop
+import hexpop
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('tables',
+                        type=str,
+                        nargs='*',
+                        help='dataset or dataset.table to migrate, '
+                        'default all in layout.ini')
+    parser.add_argument('-a',
+                        '--analyze',
+                        action='store_true',
+                        default=False,
+                        help='analyze only, do not rewrite tables')
+    parser.add_argument('-c',
+                        '--compare',
+                        action='store_true',
+                        default=False,
+                        help='compare bytes scanned by views before and after')
+    args = parser.parse_args()
+    return args.tables, args.analyze, args.compare
+
+
+def list_tables(sections):
+    """Expand dataset or dataset.table sections, maybe patterns, to ids."""
+    client = hexpop.bq_client()
+    table_ids = []
+    for section in sections:
+        dataset_id, _, pattern = section.partition('.')
+        if pattern and not any(c in pattern for c in '*?['):
+            table_ids.append('.'.join([client.project, section]))
+            continue
+        dataset_id = '.'.join([client.project, dataset_id])
+        table_ids += [
+            '.'.join([dataset_id, t.table_id])
+            for t in client.list_tables(dataset_id)
+            if t.table_type == 'TABLE'
+            and fnmatch.fnmatchcase(t.table_id, pattern or '*')
+        ]
+    return table_ids
+
+
+def target_layout(table):
+    """Determine layout for table, with region codes for geopop tables."""
+    region_codes = None
+    if table.dataset_id == 'geopop' and table.table_id in geopop.parse_ini():
+        params = geopop.parse_ini(table.table_id)
+        region_codes = [
+            getattr(params, code) for code in ['sem_code', 'bis_code']
+            if hasattr(params, code)
+        ]
+    return hexpop.parse_layout(table.dataset_id,
+                               table.table_id,
+                               region_codes=region_codes)
+
+
+def current_range(table):
+    """Summarize integer range partitioning of table, if any."""
+    if not table.range_partitioning:
+        return None
+    return (table.range_partitioning.field,
+            table.range_partitioning.range_.start,
+            table.range_partitioning.range_.end,
+            table.range_partitioning.range_.interval)
+
+
+def applied_layout(table, layout):
+    """Layout migration applies, keeping existing time partitioning.
+
+    BigQuery tables take one partitioning, so range partitioning of the
+    layout yields to time partitioning already on the table.
+    """
+    if not table.time_partitioning:
+        return layout
+    return SimpleNamespace(cluster=layout.cluster,
+                           range_column=None,
+                           range_expression=None,
+                           partition_range=None)
+
+
+def migrate_table(table, layout):
+    """Rewrite table into temporary table with layout, then swap it in.
+
+    Original is dropped only once temporary table holds every row, since
+    BigQuery cannot replace a table with a different partitioning spec.
+    """
+    dataset = hexpop.bq_client().get_dataset('.'.join(
+        [table.project, table.dataset_id]))
+    columns = [field.name for field in table.schema]
+    select = f"SELECT * FROM `{hexpop.bq_full_id(table)}`"
+    if layout.range_expression and layout.range_column not in columns:
+        select = (f"SELECT *, {layout.range_expression} AS "
+                  f"{layout.range_column} FROM `{hexpop.bq_full_id(table)}`")
+    partition, partition_hourly = None, False
+    if table.time_partitioning:  # preserve existing time partitioning
+        partition = table.time_partitioning.field
+        partition_hourly = (table.time_partitioning.type_ ==
+                            bigquery.TimePartitioningType.HOUR)
+    tmp_table = hexpop.bq_create_table(
+        dataset,
+        hexpop.bq_tmp_id(table.table_id),
+        schema=hexpop.bq_query_schema(select),
+        partition=partition,
+        partition_hourly=partition_hourly,
+        partition_range=layout.partition_range,
+        cluster=layout.cluster,
+        description=table.description,
+        force_new=True)
+    hexpop.bq_query_table(select,
+                          hexpop.bq_full_id(tmp_table),
+                          cluster=layout.cluster)
+    if (hexpop.bq_client().get_table(hexpop.bq_full_id(tmp_table)).num_rows
+            != table.num_rows):
+        hexpop.bq_delete_table(hexpop.bq_full_id(tmp_table))
+        raise RuntimeError(f"rewrite of {hexpop.bq_full_id(table)} "
+                           "lost rows, original kept")
+    hexpop.bq_delete_table(hexpop.bq_full_id(table))
+    try:
+        hexpop.bq_copy_table(hexpop.bq_full_id(tmp_table),
+                             hexpop.bq_full_id(table))
+    except Exception:
+        logger.critical("copy back failed, rows of %s kept in %s",
+                        hexpop.bq_full_id(table), hexpop.bq_full_id(tmp_table))
+        raise
+    hexpop.bq_delete_table(hexpop.bq_full_id(tmp_table))
+
+
+def views_bytes_scanned():
+    """Query each view uncached, return bytes billed by view."""
+    client = hexpop.bq_client()
+    dataset_id = '.'.join([client.project, 'views'])
+    job_config = bigquery.QueryJobConfig(use_query_cache=False)
+    scanned = {}
+    for view in client.list_tables(dataset_id):
+        if view.table_type != 'VIEW':
+            continue
+        job = client.query(
+            f"SELECT * FROM `{dataset_id}.{view.table_id}`",
+            job_config=job_config)
+        job.result()  # wait for job to complete
+        scanned[view.table_id] = job.total_bytes_billed or 0
+    return scanned
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    tables, analyze, compare = parse_args()
+    if not tables:
+        ini = configparser.ConfigParser()
+        ini.read(hexpop.LAYOUT_INI)
+        tables = ini.sections()
+    if compare:
+        scanned_before = views_bytes_scanned()
+    client = hexpop.bq_client()
+    for table_id in list_tables(tables):
+        table = client.get_table(table_id)
+        if table.time_partitioning and not table.time_partitioning.field:
+            logger.warning("%s partitioned by ingestion time, not migrated",
+                           table_id)
+            continue
+        layout = applied_layout(table, target_layout(table))
+        if (table.clustering_fields == layout.cluster
+                and current_range(table) == layout.partition_range):
+            logger.info("%s already clustered by %s, range partitioned by %s",
+                        table_id, layout.cluster, layout.partition_range)
+            continue
+        logger.info("%s clustered by %s -> %s, range partitioned by %s -> %s",
+                    table_id, table.clustering_fields, layout.cluster,
+                    current_range(table), layout.partition_range)
+        if analyze:
+            continue
+        migrate_table(table, layout)
+        logger.info("migrated %s with %d rows", table_id,
+                    client.get_table(table_id).num_rows)
+    if compare and not analyze:
+        scanned_after = views_bytes_scanned()
+        for view_id, before in sorted(scanned_before.items()):
+            after = scanned_after.get(view_id, 0)
+            logger.info("%s scanned %d -> %d bytes (%+.1f%%)", view_id,
+                        before, after, 100 * (after - before) / max(before, 1))
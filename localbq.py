@@ -0,0 +1,524 @@
+"""Run hexpop BigQuery functions locally, on DuckDB over Parquet files."""
+import datetime
+import logging
+import pathlib
+import re
+import shutil
+import time
+import uuid
+from types import SimpleNamespace
+
+import hexpop
+
+# duckdb imported where used, so BigQuery runs need not install it
+
+TYPES = {  # BigQuery schema field type, DuckDB column type
+    'STRING': 'VARCHAR',
+    'BYTES': 'BLOB',
+    'INTEGER': 'BIGINT',
+    'INT64': 'BIGINT',
+    'FLOAT': 'DOUBLE',
+    'FLOAT64': 'DOUBLE',
+    'NUMERIC': 'DECIMAL(38, 9)',
+    'BOOLEAN': 'BOOLEAN',
+    'BOOL': 'BOOLEAN',
+    'TIMESTAMP': 'TIMESTAMPTZ',
+    'DATETIME': 'TIMESTAMP',
+    'DATE': 'DATE',
+    'GEOGRAPHY': 'VARCHAR'  # as WKT
+}
+
+TRANSLATIONS = [  # BigQuery pattern, DuckDB replacement, applied in order
+    # most recent hourly partition, as hour of most recent update
+    (r"(?s)PARSE_TIMESTAMP\('%Y%m%d%H',\s*\(\s*SELECT MAX\(.*?\)\s*"
+     r"FROM `[\w-]+\.(\w+)\.INFORMATION_SCHEMA\.PARTITIONS`\s*"
+     r"WHERE table_name = '(\w+)'\s*\)\)",
+     r"""(SELECT date_trunc('hour', MAX(update_time)) FROM "\1"."\2")"""),
+    (r"ARRAY_AGG\(([^()]+?) ORDER BY ([^()]+?) DESC LIMIT 1\)"
+     r"\[OFFSET\(0\)\]", r"arg_max(\1, \2)"),
+    # project.dataset.table, backticked or not, to local schema.table
+    (r"(?<![\w.])`?[\w-]+\.(\w+)\.(\w+)`?(?![\w.])", r'"\1"."\2"'),
+    (r"`(\w+)\.(\w+)`", r'"\1"."\2"'),
+    (r"\*\s*EXCEPT\s*\(", "* EXCLUDE ("),
+    (r"\[OFFSET\((\d+)\)\]", lambda match: f"[{int(match[1]) + 1}]"),
+    (r"\bARRAY_LENGTH\(", "len("),
+    (r"\bSPLIT\(", "string_split("),
+    (r"\bCOUNTIF\(", "count_if("),
+    (r"\bRAND\(\)", "random()"),
+    (r"\bCURRENT_TIMESTAMP\(\)", "current_timestamp"),
+    (r"\bTIMESTAMP_SUB\(([^,]+),\s*(INTERVAL [^)]+)\)", r"(\1 - \2)"),
+    (r"\bTIMESTAMP\(('[^']*')\)", r"CAST(\1 AS TIMESTAMPTZ)"),
+    (r"\bUNION DISTINCT\b", "UNION"),
+    (r"\bINT64\b", "BIGINT"),
+    (r"\bFLOAT64\b", "DOUBLE"),
+    (r"\bST_GEOGFROMTEXT\(([^,()]+),\s*make_valid => TRUE\)",
+     r"ST_GeomFromText(\1)")
+]
+
+UNSUPPORTED = [  # BigQuery pattern, construct without DuckDB equivalent
+    (r"\bjslibs\.[\w.]+", 'JS UDF'),
+]
+
+REFERENCE = r'"(\w+)"\."(\w+)"'
+DML = r'^\s*(?:DELETE\s+FROM|UPDATE|INSERT\s+INTO)\s+"(\w+)"\."(\w+)"'
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('table_ids',
+                        type=str,
+                        nargs='+',
+                        help='BigQuery tables or views to export locally, '
+                        'as project.dataset.table')
+    parser.add_argument('-w',
+                        '--where',
+                        type=str,
+                        default=None,
+                        help='SQL condition limiting rows exported')
+    args = parser.parse_args()
+    return args.table_ids, args.where
+
+
+def unsupported(query):
+    """Constructs of BigQuery SQL query with no DuckDB translation."""
+    return sorted({
+        f"{construct} {match}"
+        for pattern, construct in UNSUPPORTED
+        for match in re.findall(pattern, query)
+    })
+
+
+def translate(query):
+    """Translate BigQuery SQL constructs used by hexpop to DuckDB SQL."""
+    constructs = unsupported(query)
+    if constructs:
+        raise ValueError(
+            f"{', '.join(constructs)} not supported by duckdb backend, "
+            'export the resulting table from BigQuery with localbq.py')
+    for pattern, replacement in TRANSLATIONS:
+        query = re.sub(pattern, replacement, query)
+    return query
+
+
+def _split(table_id):
+    """Dataset and table of table object or id, project ignored."""
+    if isinstance(table_id, tuple):
+        return table_id
+    if hasattr(table_id, 'table_id'):
+        return table_id.dataset_id, table_id.table_id
+    return tuple(str(table_id).replace(':', '.').split('.')[-2:])
+
+
+def _path(dataset_id, table_id=None):
+    path = hexpop.backend().path / dataset_id
+    return path / table_id if table_id else path
+
+
+def _parts(dataset_id, table_id):
+    """Parquet files holding rows of table, in order written."""
+    return sorted(_path(dataset_id, table_id).glob('*.parquet'))
+
+
+def _view_path(dataset_id, table_id):
+    return _path(dataset_id, table_id).with_suffix('.sql')
+
+
+def _connect(query=''):
+    """Connect to DuckDB in memory, with tables and views query references."""
+    import duckdb
+    connection = duckdb.connect()
+    connection.execute("SET TimeZone = 'UTC'")  # as BigQuery
+    if re.search(r'\bST_\w+\(', query):  # geography, if extension loads
+        connection.execute('INSTALL spatial; LOAD spatial')
+    _register(connection, query, set())
+    return connection
+
+
+def _register(connection, query, registered):
+    """Create DuckDB views of Parquet tables and local views, recursively."""
+    import duckdb
+    for dataset_id, table_id in set(re.findall(REFERENCE, query)):
+        if (dataset_id, table_id) in registered:
+            continue
+        registered.add((dataset_id, table_id))
+        name = f'"{dataset_id}"."{table_id}"'
+        view_path = _view_path(dataset_id, table_id)
+        if view_path.exists():
+            view_query = translate(view_path.read_text())
+            _register(connection, view_query, registered)
+        elif _parts(dataset_id, table_id):
+            view_query = ("SELECT * FROM read_parquet('"
+                          f"{_path(dataset_id, table_id)}/*.parquet', "
+                          "union_by_name = true)")
+        else:
+            continue  # not found, as query will report
+        connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset_id}"')
+        try:
+            connection.execute(f"CREATE VIEW {name} AS {view_query}")
+        except duckdb.CatalogException:
+            continue  # view of table not found, as query will report
+
+
+def _columns(connection, select):
+    """Schema of select statement as names and DuckDB types."""
+    return [
+        SimpleNamespace(name=row[0], field_type=row[1])
+        for row in connection.execute(f"DESCRIBE {select}").fetchall()
+    ]
+
+
+class Client:
+    """Local stand-in for the BigQuery client methods hexpop scripts use."""
+
+    def __init__(self, project):
+        self.project = project
+
+    def get_dataset(self, dataset_id):
+        """Dataset, if its directory exists."""
+        from google.api_core.exceptions import NotFound
+        dataset_id = str(dataset_id).split('.')[-1]
+        if not _path(dataset_id).is_dir():
+            raise NotFound(f"local dataset {dataset_id}")
+        return SimpleNamespace(project=self.project,
+                               dataset_id=dataset_id,
+                               full_dataset_id=f"{self.project}:{dataset_id}")
+
+    def get_table(self, table):
+        """Table or view with BigQuery attributes used by scripts."""
+        from google.api_core.exceptions import NotFound
+        dataset_id, table_id = _split(table)
+        view_path = _view_path(dataset_id, table_id)
+        path = _path(dataset_id, table_id)
+        if view_path.exists():
+            files, table_type = [view_path], 'VIEW'
+        elif path.is_dir():
+            files, table_type = _parts(dataset_id, table_id) + [path], 'TABLE'
+        else:
+            raise NotFound(f"local table {dataset_id}.{table_id}")
+        num_rows, schema = 0, []
+        if table_type == 'TABLE' and len(files) > 1:
+            select = (f"SELECT * FROM read_parquet('{path}/*.parquet', "
+                      "union_by_name = true)")
+            with _connect() as connection:
+                num_rows = connection.execute(
+                    f"SELECT COUNT(*) FROM ({select})").fetchone()[0]
+                schema = _columns(connection, select)
+        return SimpleNamespace(
+            project=self.project,
+            dataset_id=dataset_id,
+            table_id=table_id,
+            full_table_id=f"{self.project}:{dataset_id}.{table_id}",
+            table_type=table_type,
+            view_query=view_path.read_text() if view_path.exists() else None,
+            num_rows=num_rows,
+            schema=schema,
+            modified=datetime.datetime.fromtimestamp(
+                max(f.stat().st_mtime for f in files), datetime.timezone.utc))
+
+    def list_tables(self, dataset):
+        """Tables and views in dataset."""
+        dataset_id = getattr(dataset, 'dataset_id', str(dataset))
+        dataset_id = dataset_id.split('.')[-1]
+        return [
+            self.get_table((dataset_id, path.stem))
+            for path in sorted(_path(dataset_id).iterdir())
+            if path.is_dir() or path.suffix == '.sql'
+        ]
+
+    def delete_table(self, table, not_found_ok=False):
+        """Delete table or view."""
+        from google.api_core.exceptions import NotFound
+        dataset_id, table_id = _split(table)
+        view_path = _view_path(dataset_id, table_id)
+        path = _path(dataset_id, table_id)
+        if view_path.exists():
+            view_path.unlink()
+        elif path.is_dir():
+            shutil.rmtree(path)
+        elif not not_found_ok:
+            raise NotFound(f"local table {dataset_id}.{table_id}")
+
+
+def client():
+    """Set up local client, with project named in hexpop.ini."""
+    return Client(hexpop.backend().project)
+
+
+def prep_dataset(dataset_name, list_tables=False, test_dataset=False):
+    """Check that local dataset directory is ready."""
+    local = client()
+    if test_dataset:
+        dataset_name += '_test'
+    _path(dataset_name).mkdir(parents=True, exist_ok=True)
+    dataset = local.get_dataset(dataset_name)
+    if list_tables:
+        return dataset, [
+            t.table_id for t in local.list_tables(dataset)
+            if t.table_type == 'TABLE'
+        ]
+    return dataset
+
+
+def form_schema(fields):
+    """Convert list of (name, field_type) tuples into local schema."""
+    return [
+        SimpleNamespace(name=x[0].strip(), field_type=x[1].strip())
+        for x in fields
+    ]
+
+
+def _write(connection, select, dataset_id, table_id, schema=None):
+    """Write rows of select as new Parquet part, cast to table schema."""
+    types = {
+        field.name: TYPES.get(field.field_type.upper(), field.field_type)
+        for field in schema or []
+    }
+    if not types and _parts(dataset_id, table_id):  # match existing parts
+        types = {
+            field.name: field.field_type
+            for field in _columns(
+                connection, "SELECT * FROM read_parquet('"
+                f"{_path(dataset_id, table_id)}/*.parquet', "
+                "union_by_name = true)")
+        }
+    columns = [field.name for field in _columns(connection, select)]
+    casts = ', '.join(f'CAST("{c}" AS {types[c]}) AS "{c}"'
+                      if c in types else f'"{c}"' for c in columns)
+    path = _path(dataset_id, table_id)
+    path.mkdir(parents=True, exist_ok=True)
+    part = path / f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+    connection.execute(f"COPY (SELECT {casts} FROM ({select})) "
+                       f"TO '{part}' (FORMAT PARQUET)")
+    return connection.execute(
+        f"SELECT COUNT(*) FROM read_parquet('{part}')").fetchone()[0]
+
+
+def _stats(job_type, destination, output_rows, time_start):
+    """Record local job statistics alongside those of BigQuery jobs."""
+    hexpop.bq_job_stats(
+        SimpleNamespace(job_id=f"local_{uuid.uuid4().hex}",
+                        job_type=job_type,
+                        destination=destination,
+                        output_rows=output_rows), time_start)
+
+
+def create_table(dataset,
+                 table_id,
+                 schema=None,
+                 partition=None,
+                 partition_hourly=False,
+                 partition_range=None,
+                 cluster=None,
+                 description=None,
+                 force_new=False):
+    """Create local table, forcefully if required.
+
+    Partitioning and clustering have no local equivalent and are ignored.
+    """
+    local = client()
+    if force_new:
+        local.delete_table((dataset.dataset_id, table_id), not_found_ok=True)
+    path = _path(dataset.dataset_id, table_id)
+    if not path.is_dir():
+        path.mkdir(parents=True)
+        if schema:  # empty part, so queries see columns
+            with _connect() as connection:
+                _write(
+                    connection, 'SELECT ' + ', '.join(
+                        f'CAST(NULL AS VARCHAR) AS "{field.name}"'
+                        for field in schema) + ' LIMIT 0', dataset.dataset_id,
+                    table_id, schema)
+    return local.get_table((dataset.dataset_id, table_id))
+
+
+def create_view(dataset, view_id, view_query, force_new=False):
+    """Create local view forcefully if required, translated when queried."""
+    local = client()
+    if force_new:
+        local.delete_table((dataset.dataset_id, view_id), not_found_ok=True)
+    view_path = _view_path(dataset.dataset_id, view_id)
+    if not view_path.exists():
+        view_path.write_text(view_query)
+    return local.get_table((dataset.dataset_id, view_id))
+
+
+def estimate_query(query):
+    """Estimate bytes query would scan, as size of Parquet files referenced."""
+    query, seen, total = translate(query), set(), 0
+    while True:
+        references = set(re.findall(REFERENCE, query)) - seen
+        if not references:
+            return total
+        seen |= references
+        query = ''
+        for dataset_id, table_id in references:
+            view_path = _view_path(dataset_id, table_id)
+            if view_path.exists():
+                query += translate(view_path.read_text())
+            total += sum(
+                f.stat().st_size for f in _parts(dataset_id, table_id))
+
+
+def query_schema(query):
+    """Schema of local query results, as names and DuckDB types."""
+    query = translate(query)
+    with _connect(query) as connection:
+        return _columns(connection, query)
+
+
+def load_table(df, table_id, schema=None, write='WRITE_APPEND'):
+    """Load Pandas dataframe into local table as Parquet part."""
+    dataset_id, table_id = _split(table_id)
+    if write == 'WRITE_TRUNCATE':
+        client().delete_table((dataset_id, table_id), not_found_ok=True)
+    time_start = time.perf_counter()
+    with _connect() as connection:
+        connection.register('df', df)
+        output_rows = _write(connection, 'SELECT * FROM df', dataset_id,
+                             table_id, schema)
+        result = SimpleNamespace(output_rows=output_rows,
+                                 schema=_columns(connection,
+                                                 'SELECT * FROM df'))
+    _stats('load', f"{dataset_id}.{table_id}", output_rows, time_start)
+    return result
+
+
+def _modify(query, dataset_id, table_id, time_start):
+    """Run DML on DuckDB copy of table, then replace its Parquet parts."""
+    previous = _parts(dataset_id, table_id)
+    if not previous:
+        return None
+    name = f'"{dataset_id}"."{table_id}"'
+    with _connect(query) as connection:
+        connection.execute(f"DROP VIEW {name}")  # base table for DML
+        connection.execute(f"CREATE TABLE {name} AS SELECT * FROM "
+                           f"read_parquet('{_path(dataset_id, table_id)}/"
+                           "*.parquet', union_by_name = true)")
+        affected_rows = connection.execute(query).fetchone()[0]
+        _write(connection, f"SELECT * FROM {name}", dataset_id, table_id)
+    for part in previous:  # once modified table written
+        part.unlink()
+    _stats('query', f"{dataset_id}.{table_id}", affected_rows, time_start)
+    return SimpleNamespace(total_rows=0, num_dml_affected_rows=affected_rows)
+
+
+def query_table(query,
+                destination=None,
+                write='WRITE_APPEND',
+                cluster=None):
+    """Query local tables using BigQuery SQL, translated for DuckDB."""
+    import duckdb
+    query = translate(query)
+    time_start = time.perf_counter()
+    dml = re.match(DML, query, flags=re.IGNORECASE)
+    if dml:  # Parquet views take no DML, so rewrite table
+        return _modify(query, *dml.groups(), time_start)
+    with _connect(query) as connection:
+        try:
+            if not destination:
+                df = connection.execute(query).df()
+                _stats('query', None, df.shape[0], time_start)
+                return SimpleNamespace(total_rows=df.shape[0],
+                                       schema=_columns(connection, query),
+                                       to_dataframe=lambda: df)
+            dataset_id, table_id = _split(destination)
+            previous = _parts(dataset_id, table_id)
+            if cluster:  # sorted row groups, nearest local equivalent
+                query = f"SELECT * FROM ({query}) ORDER BY " + ', '.join(
+                    f'"{c}"' for c in cluster)
+            total_rows = _write(connection, query, dataset_id, table_id)
+        except duckdb.CatalogException:
+            return None
+    if write == 'WRITE_TRUNCATE':  # once query succeeds
+        for part in previous:
+            part.unlink()
+    _stats('query', f"{dataset_id}.{table_id}", total_rows, time_start)
+    return SimpleNamespace(total_rows=total_rows,
+                           to_dataframe=lambda: query_table(
+                               f'SELECT * FROM "{dataset_id}"."{table_id}"'
+                           ).to_dataframe())
+
+
+def query_batches(query, page_size=None):
+    """Query local tables using BigQuery SQL, stream Arrow batches."""
+    import duckdb
+    query = translate(query)
+    time_start = time.perf_counter()
+    connection = _connect(query)  # open until batches read
+    try:
+        total_rows = connection.execute(
+            f"SELECT COUNT(*) FROM ({query})").fetchone()[0]
+        reader = connection.execute(query).fetch_record_batch(page_size or
+                                                              100000)
+    except duckdb.CatalogException:
+        connection.close()
+        return None
+    _stats('query', None, total_rows, time_start)
+    return SimpleNamespace(total_rows=total_rows, batches=iter(reader))
+
+
+def query_chunks(query, destination, chunk_rows=100000):
+    """Query local tables into destination table, stream it in chunks."""
+    result = query_table(query, destination, write='WRITE_TRUNCATE')
+    if result is None:
+        return None
+    dataset_id, table_id = _split(destination)
+
+    def batches():
+        for offset in range(0, result.total_rows, chunk_rows):
+            chunk = (f'SELECT * FROM "{dataset_id}"."{table_id}" '
+                     f'LIMIT {chunk_rows} OFFSET {offset}')
+            with _connect(chunk) as connection:  # fresh read for each chunk
+                yield from connection.execute(chunk).fetch_record_batch(
+                    chunk_rows)
+
+    return SimpleNamespace(total_rows=result.total_rows, batches=batches())
+
+
+def copy_table(source_id, destination_id, write='WRITE_EMPTY'):
+    """Copy local table Parquet parts to destination table."""
+    from google.api_core.exceptions import Conflict
+    source = _split(source_id)
+    destination = _split(destination_id)
+    if write == 'WRITE_TRUNCATE':
+        client().delete_table(destination, not_found_ok=True)
+    elif write == 'WRITE_EMPTY' and _parts(*destination):
+        raise Conflict(f"local table {'.'.join(destination)} not empty")
+    time_start = time.perf_counter()
+    _path(*destination).mkdir(parents=True, exist_ok=True)
+    for part in _parts(*source):
+        shutil.copy2(part, _path(*destination) / part.name)
+    result = client().get_table(destination)
+    _stats('copy', '.'.join(destination), result.num_rows, time_start)
+    return result
+
+
+def delete_table(table_id):
+    """Delete local table, if present."""
+    client().delete_table(table_id, not_found_ok=True)
+
+
+def storage_client():
+    """No Storage API locally, batches read from DuckDB directly."""
+    return None
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    table_ids, where = parse_args()
+    from google.cloud import bigquery
+    bq = bigquery.Client(credentials=hexpop._credentials())
+    for table_id in table_ids:
+        time_start = time.perf_counter()
+        query = f"SELECT * FROM `{table_id}`"
+        if where:
+            query += f" WHERE {where}"
+        df = bq.query(query).to_dataframe()
+        dataset_id, local_id = _split(table_id)
+        prep_dataset(dataset_id)
+        load_table(df, f"{dataset_id}.{local_id}", write='WRITE_TRUNCATE')
+        logger.info("exported %s to %s, %d rows in %d seconds", table_id,
+                    _path(dataset_id, local_id), df.shape[0],
+                    time.perf_counter() - time_start)
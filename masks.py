@@ -0,0 +1,143 @@
+"""Build territory masks as compacted H3 cells, filter hexes by mask."""
+import configparser
+import json
+import logging
+import pathlib
+from types import SimpleNamespace
+
+import h3
+import numpy
+
+import geopop
+import hexarray
+import hexpop
+
+TERRITORY_GEOMS = """
+SELECT ST_ASGEOJSON({sem_geom}) AS geojson FROM {sem_source}
+WHERE CAST({sem_code} AS STRING) IN ({codes})
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('territories',
+                        type=str,
+                        nargs='*',
+                        help='territories for which to build masks, '
+                        'default all in masks.ini')
+    args = parser.parse_args()
+    return args.territories
+
+
+def parse_ini(territory=None):
+    """Parse territory configurations from .ini file."""
+    ini = configparser.ConfigParser()
+    ini.read(pathlib.Path(__file__).with_suffix('.ini'))
+    if not territory:
+        return ini.sections()
+    return SimpleNamespace(
+        name=territory,
+        region=ini.get(territory, 'region'),
+        codes=[
+            c.strip() for c in ini.get(territory, 'codes').split(',')
+            if c.strip()
+        ])
+
+
+def mask_path(territory):
+    """Location of precomputed mask on disk."""
+    return hexpop.CACHE_DIR / f"mask_{territory}.npz"
+
+
+class Mask:
+    """Compacted H3 cells of territory, sorted by resolution."""
+
+    def __init__(self, name, cells):
+        self.name = name
+        resolutions = hexarray.get_resolution(cells)
+        self.levels = {
+            int(res): hexarray.HexSet(cells[resolutions == res])
+            for res in numpy.unique(resolutions)
+        }
+
+    def contains(self, h3_ints):
+        """Vectorized membership of uint64 hex array within territory."""
+        h3_ints = numpy.asarray(h3_ints, dtype=numpy.uint64)
+        inside = numpy.zeros(h3_ints.shape, dtype=bool)
+        for res, cells in self.levels.items():
+            inside |= cells.contains(hexarray.to_parent(h3_ints, res))
+        return inside
+
+    def filter(self, data, column='h3_index'):
+        """Subset of HexSet, or dataframe rows with hexes within territory."""
+        if isinstance(data, hexarray.HexSet):
+            return hexarray.HexSet(data.ints[self.contains(data.ints)],
+                                   is_sorted=True)
+        hexes = data[column]
+        if hexes.dtype.kind != 'u':  # H3 index strings
+            hexes = hexarray.to_ints(hexes)
+        return data[self.contains(hexes)]
+
+    def cells(self):
+        """All compacted cells as uint64 array."""
+        return numpy.concatenate([c.ints for c in self.levels.values()])
+
+    def __contains__(self, h3_index):
+        if isinstance(h3_index, str):
+            h3_index = int(h3_index, 16)
+        return bool(self.contains(numpy.uint64(h3_index)))
+
+    def __repr__(self):
+        return f"Mask({self.name}, {self.cells().size} cells)"
+
+
+def polyfill(geojson, resolution=8):
+    """Hexes with centroids inside GeoJSON polygon or multipolygon."""
+    geometry = json.loads(geojson)
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+    hexes = set()
+    for coordinates in polygons:
+        polygon = {'type': 'Polygon', 'coordinates': coordinates}
+        hexes |= h3.polyfill(polygon, resolution, geo_json_conformant=True)
+    return hexes
+
+
+def build_mask(territory, project):
+    """Polyfill territory boundaries, compact, and save mask to disk."""
+    params = parse_ini(territory)
+    region = geopop.parse_ini(params.region)
+    df = hexpop.bq_query_table(
+        TERRITORY_GEOMS.format(
+            sem_geom=region.sem_geom,
+            sem_source=region.sem_source.format(project=project),
+            sem_code=region.sem_code,
+            codes=', '.join(f"'{c}'" for c in params.codes)))
+    cells = numpy.unique(
+        numpy.concatenate([numpy.empty(0, dtype=numpy.uint64)] + [
+            hexarray.to_ints(h3.compact(polyfill(geojson)))
+            for geojson in df.to_dataframe()['geojson']
+        ]))
+    mask_path(territory).parent.mkdir(parents=True, exist_ok=True)
+    numpy.savez(mask_path(territory), cells=cells)
+    return Mask(territory, cells)
+
+
+def load_mask(territory):
+    """Load precomputed mask from disk."""
+    with numpy.load(mask_path(territory)) as saved:
+        return Mask(territory, saved['cells'])
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    territories = parse_args() or parse_ini()
+    project = hexpop.bq_prep_dataset('geopop').project
+    for territory in territories:
+        mask = build_mask(territory, project)
+        logger.info("%s saved to %s with %s cells by resolution", mask,
+                    mask_path(territory),
+                    {res: len(c) for res, c in mask.levels.items()})
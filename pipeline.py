@@ -0,0 +1,298 @@
+"""Run pipeline stages concurrently in dependency order, skip up-to-date."""
+import concurrent.futures
+import configparser
+import logging
+import pathlib
+import re
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import geopop
+import hexpop
+import localbq
+import views
+
+HERE = pathlib.Path(__file__).parent
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('-s',
+                        '--select',
+                        type=str,
+                        nargs='*',
+                        default=['public', 'geopop', 'view'],
+                        help='run nodes of these kinds or names, '
+                        'treating others as done, coverage if selected, '
+                        'public sources not unattended only if named')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=4,
+                        help='maximum number of nodes running at once')
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        default=False,
+                        help='run nodes even if up to date')
+    parser.add_argument('-x',
+                        '--expire',
+                        type=int,
+                        default=7,
+                        help='refetch Mappers coverage older than EXPIRE days')
+    parser.add_argument('-d',
+                        '--dry_run',
+                        action='store_true',
+                        default=False,
+                        help='list nodes in dependency order, do not run')
+    args = parser.parse_args()
+    return args.select, args.jobs, args.force, args.expire, args.dry_run
+
+
+def references(query, project):
+    """Tables in project referenced by query, as dataset.table ids."""
+    return {
+        '.'.join(ref)
+        for ref in re.findall(rf"{re.escape(project)}\.(\w+)\.(\w+)", query)
+    }
+
+
+def command_node(name, outputs, inputs, command):
+    """Node running entry point in subprocess."""
+    return SimpleNamespace(
+        name=name,
+        outputs=outputs,
+        inputs=inputs,
+        view=None,
+        named_only=False,
+        run=lambda: subprocess.run([sys.executable] + command,
+                                   cwd=HERE,
+                                   check=True))
+
+
+def view_node(spec, project):
+    """Node creating view in process."""
+    return SimpleNamespace(
+        name=f"view:{spec.view_id}",
+        outputs=[f"{spec.dataset.dataset_id}.{spec.view_id}"],
+        inputs=references(spec.query, project),
+        view=spec,
+        named_only=False,
+        run=lambda: hexpop.bq_create_view(
+            spec.dataset, spec.view_id, spec.query, force_new=True))
+
+
+def build_nodes(project, datasets, expire):
+    """Nodes for public sources, geopop regions, coverage, and views."""
+    nodes = []
+    ini = configparser.ConfigParser()
+    ini.read(HERE / 'public.ini')
+    local = hexpop.backend().engine == 'duckdb'
+    for source in ini.sections():  # table named as in public.py
+        if local and localbq.unsupported(ini.get(source, 'recast_query')):
+            continue  # load in BigQuery, export with localbq.py
+        table = ini.get(source, 'path').rsplit('/', 1)[-1].split('.')[0]
+        node = command_node(f"public:{source}", [f"public.{table}"], set(),
+                            ['public.py', source])
+        node.named_only = not ini.getboolean(
+            source, 'unattended', fallback=True)
+        nodes.append(node)
+    nodes.append(
+        command_node('public:statoids', ['public.statoids_usa_counties'],
+                     set(), ['statoids.py']))
+    regions = geopop.parse_ini()
+    for region in regions:
+        nodes.append(
+            command_node(
+                f"geopop:{region}", [f"geopop.{region}"],
+                references(
+                    geopop.parse_ini(region).geo_query.format(
+                        project=project,
+                        population=geopop.population_table()), project),
+                ['geopop.py', region]))
+    nodes.append(
+        command_node('coverage:explorer', ['coverage.explorer_updates'],
+                     set(), ['coverexp.py']))
+    nodes.append(
+        command_node('coverage:mappers',
+                     ['coverage.mappers_updates', 'coverage.mappers_children'],
+                     {f"geopop.{r}"
+                      for r in regions if r != 'gadm'},
+                     ['covermap.py', '-x', str(expire)]))
+    for spec in views.view_specs(datasets['geopop'], datasets['coverage'],
+                                 datasets['views'], regions):
+        if local and localbq.unsupported(spec.query):
+            continue
+        nodes.append(view_node(spec, project))
+    producers = {
+        output: node.name
+        for node in nodes for output in node.outputs
+    }
+    for node in nodes:
+        node.deps = {
+            producers[i]
+            for i in node.inputs
+            if i in producers and producers[i] != node.name
+        }
+    return {node.name: node for node in nodes}
+
+
+def up_to_date(node, client):
+    """View exists with same query, or table newer than its inputs."""
+    from google.api_core.exceptions import NotFound
+
+    def get(table_id):
+        try:
+            return client.get_table(f"{client.project}.{table_id}")
+        except NotFound:
+            return None
+
+    if node.name.startswith('coverage:'):
+        return False  # surveys always have more to fetch
+    outputs = [get(output) for output in node.outputs]
+    if not all(outputs):
+        return False
+    if node.view:
+        return outputs[0].view_query == node.view.query
+    inputs = [table for table in map(get, node.inputs) if table]
+    latest = max((table.modified for table in inputs), default=None)
+    return latest is None or all(t.modified >= latest for t in outputs)
+
+
+def waves(nodes):
+    """Node names grouped by dependency depth."""
+    depth = {}
+
+    def visit(name):
+        if name not in depth:
+            depth[name] = 1 + max(
+                (visit(d) for d in nodes[name].deps), default=-1)
+        return depth[name]
+
+    for name in nodes:
+        visit(name)
+    return [
+        sorted(n for n in nodes if depth[n] == level)
+        for level in range(max(depth.values(), default=-1) + 1)
+    ]
+
+
+def execute(node, client, force, time_zero):
+    """Run node unless up to date, recording status and timing."""
+    start = time.perf_counter() - time_zero
+    if not force and up_to_date(node, client):
+        status = 'fresh'
+    else:
+        hexpop.count('nodes_run')
+        node.run()
+        status = 'ran'
+    return SimpleNamespace(status=status,
+                           start=start,
+                           end=time.perf_counter() - time_zero)
+
+
+def run_pipeline(nodes, selected, jobs, force):
+    """Run ready nodes concurrently up to jobs limit, return results."""
+    client = hexpop.bq_client()
+    time_zero = time.perf_counter()
+    results = {
+        name: SimpleNamespace(status='unselected', start=0.0, end=0.0)
+        for name in nodes if name not in selected
+    }
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(results) < len(nodes):
+            settled = len(results)
+            for name in selected:
+                if name in results or name in running.values():
+                    continue
+                statuses = [results.get(d) for d in nodes[name].deps]
+                if any(s and s.status in ['failed', 'blocked']
+                       for s in statuses):
+                    now = time.perf_counter() - time_zero
+                    results[name] = SimpleNamespace(status='blocked',
+                                                    start=now,
+                                                    end=now)
+                elif all(statuses):
+                    logger.info("%s started", name)
+                    running[executor.submit(execute, nodes[name], client,
+                                            force, time_zero)] = name
+            if not running:
+                if len(results) > settled:
+                    continue  # newly blocked nodes may block others
+                break  # nothing running, nothing can start
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as err:  # keep independent nodes running
+                    logger.error("%s failed: %s", name, err)
+                    now = time.perf_counter() - time_zero
+                    results[name] = SimpleNamespace(status='failed',
+                                                    start=now,
+                                                    end=now)
+                    continue
+                logger.info("%s %s in %.1f seconds", name,
+                            results[name].status,
+                            results[name].end - results[name].start)
+    now = time.perf_counter() - time_zero
+    for name in nodes:  # waiting on dependencies never resolved
+        results.setdefault(
+            name, SimpleNamespace(status='blocked', start=now, end=now))
+    return results
+
+
+def critical_path(nodes, results):
+    """Longest chain of node durations through dependencies."""
+    chain = {}
+
+    def longest(name):
+        if name not in chain:
+            duration = results[name].end - results[name].start
+            before = max((longest(d) for d in nodes[name].deps),
+                         default=(0.0, []))
+            chain[name] = (before[0] + duration, before[1] + [name])
+        return chain[name]
+
+    return max((longest(name) for name in nodes), default=(0.0, []))
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    select, jobs, force, expire, dry_run = parse_args()
+    datasets = {
+        name: hexpop.bq_prep_dataset(name)
+        for name in ['geopop', 'coverage', 'views']
+    }
+    nodes = build_nodes(datasets['views'].project, datasets, expire)
+    selected = [
+        n for n in nodes if n in select or
+        (n.split(':')[0] in select and not nodes[n].named_only)
+    ]
+    if dry_run:
+        for level, names in enumerate(waves(nodes)):
+            for name in names:
+                logger.info("%d %s%s <- %s", level, name,
+                            '' if name in selected else ' (unselected)',
+                            ', '.join(sorted(nodes[name].deps)) or 'none')
+        sys.exit()
+    time_start = time.perf_counter()
+    results = run_pipeline(nodes, selected, jobs, force)
+    wall = time.perf_counter() - time_start
+    for status in ['ran', 'fresh', 'failed', 'blocked']:
+        names = [n for n, r in results.items() if r.status == status]
+        if names:
+            logger.info("%d %s: %s", len(names), status, ', '.join(names))
+    seconds, path = critical_path(nodes, results)
+    logger.info(
+        "critical path %.1f seconds: %s", seconds, ' -> '.join(
+            f"{n} ({results[n].end - results[n].start:.1f})" for n in path
+            if results[n].status != 'unselected'))
+    logger.info("wall %.1f seconds, sum of nodes %.1f seconds", wall,
+                sum(r.end - r.start for r in results.values()))
@@ -0,0 +1,230 @@
+"""Patch geopop tables and views with delta between population releases."""
+import logging
+import pathlib
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy
+import pandas
+
+import geopop
+import hexarray
+import hexpop
+import views
+
+POPULATION = """
+SELECT h3_index, population FROM `{project}.public.{population}`
+"""
+
+ADDED_POPULATION = """
+SELECT * FROM `{project}.public.{population}`
+WHERE h3_index IN (SELECT h3_index FROM `{project}.public.{delta}`
+  WHERE change = 'added')
+"""
+
+# added hexes deleted too, before inserting them, so patch can be rerun
+DELETE_ADDED_REMOVED = """
+DELETE FROM `{project}.{regional_dataset}.{region}`
+WHERE h3_index IN (SELECT h3_index FROM `{project}.public.{delta}`
+  WHERE change IN ('added', 'removed'))
+"""
+
+UPDATE_CHANGED = """
+UPDATE `{project}.{regional_dataset}.{region}` AS geopop
+SET population = delta.new_population
+FROM `{project}.public.{delta}` AS delta
+WHERE geopop.h3_index = delta.h3_index AND delta.change = 'changed'
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('new',
+                        type=str,
+                        help='table of new population release, '
+                        'in public dataset')
+    parser.add_argument('-o',
+                        '--old',
+                        type=str,
+                        default=None,
+                        help='table of old population release, '
+                        'default current in geopop.ini')
+    parser.add_argument('-r',
+                        '--regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions whose geopop tables to patch')
+    parser.add_argument('-d',
+                        '--dry_run',
+                        action='store_true',
+                        default=False,
+                        help='compute and report delta, do not patch')
+    args = parser.parse_args()
+    return args.new, args.old, args.regions, args.dry_run
+
+
+def read_release(project, population):
+    """H3 indexes and population of release, sorted by index."""
+    result = hexpop.bq_query_batches(
+        POPULATION.format(project=project, population=population))
+    if result is None:
+        return None
+    hexes, pops = [numpy.empty(0, dtype=numpy.uint64)], [numpy.empty(0)]
+    for record_batch in result.batches:  # one batch in pandas at a time
+        df = record_batch.to_pandas()
+        hexes.append(hexarray.to_ints(df['h3_index']))
+        pops.append(df['population'].to_numpy())
+    hexes = numpy.concatenate(hexes)
+    order = numpy.argsort(hexes, kind='stable')
+    return SimpleNamespace(hexes=hexes[order],
+                           population=numpy.concatenate(pops).astype(
+                               numpy.int64)[order])
+
+
+def delta(old, new):
+    """Added, removed, and changed hexes between sorted releases.
+
+    Sorted merge of the two index arrays; population of absent hex is 0.
+    """
+    _, old_pos, new_pos = numpy.intersect1d(old.hexes,
+                                            new.hexes,
+                                            assume_unique=True,
+                                            return_indices=True)
+    added = numpy.ones(new.hexes.size, dtype=bool)
+    added[new_pos] = False
+    removed = numpy.ones(old.hexes.size, dtype=bool)
+    removed[old_pos] = False
+    changed = old.population[old_pos] != new.population[new_pos]
+    sizes = [added.sum(), removed.sum(), changed.sum()]
+    df = pandas.DataFrame({
+        'h3_index':
+        numpy.concatenate([
+            new.hexes[added], old.hexes[removed], old.hexes[old_pos[changed]]
+        ]),
+        'old_population':
+        numpy.concatenate([
+            numpy.zeros(sizes[0], dtype=numpy.int64), old.population[removed],
+            old.population[old_pos[changed]]
+        ]),
+        'new_population':
+        numpy.concatenate([
+            new.population[added],
+            numpy.zeros(sizes[1], dtype=numpy.int64),
+            new.population[new_pos[changed]]
+        ]),
+        'change':
+        numpy.repeat(['added', 'removed', 'changed'], sizes)
+    }).sort_values('h3_index', ignore_index=True)
+    df['h3_index'] = hexarray.to_strings(df['h3_index'].to_numpy())
+    return df
+
+
+def switch_release(population):
+    """Point geopop.ini at population release, keeping its comments."""
+    ini_path = pathlib.Path(geopop.__file__).with_suffix('.ini')
+    ini_path.write_text(
+        re.sub(r'^population: .*$',
+               f"population: {population}",
+               ini_path.read_text(),
+               count=1,
+               flags=re.MULTILINE))
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    new, old, regions, dry_run = parse_args()
+    old = old or geopop.population_table()
+    time_start = time.perf_counter()
+    public = hexpop.bq_prep_dataset('public')
+    regional = hexpop.bq_prep_dataset('geopop')
+    with hexpop.stage('read') as read:
+        releases = [read_release(public.project, p) for p in [old, new]]
+        if not all(releases):
+            logger.critical("population table %s or %s not found", old, new)
+            sys.exit(1)
+        read.rows = sum(release.hexes.size for release in releases)
+    with hexpop.stage('delta') as merge:
+        df_delta = delta(*releases)
+        merge.rows = df_delta.shape[0]
+    changes = df_delta['change'].value_counts()
+    logger.info(
+        "%s to %s: %d added, %d removed, %d changed of %d hexes, "
+        "net %+d pops", old, new, changes.get('added', 0),
+        changes.get('removed', 0), changes.get('changed', 0),
+        releases[1].hexes.size,
+        df_delta['new_population'].sum() - df_delta['old_population'].sum())
+    if dry_run or df_delta.empty:
+        sys.exit()
+    delta_id = f"popdelta_{new}"
+    hexpop.bq_load_table(df_delta,
+                         '.'.join([public.project, public.dataset_id,
+                                   delta_id]),
+                         schema=hexpop.bq_form_schema([
+                             ('h3_index', 'STRING'),
+                             ('old_population', 'INTEGER'),
+                             ('new_population', 'INTEGER'),
+                             ('change', 'STRING')
+                         ]),
+                         write='WRITE_TRUNCATE')
+    added_view = hexpop.bq_create_view(
+        public,
+        f"{delta_id}_added",
+        ADDED_POPULATION.format(project=public.project,
+                                population=new,
+                                delta=delta_id),
+        force_new=True)
+    patched = set()
+    for region in hexpop.clean_regions(regions):
+        params = geopop.parse_ini(region)
+        format_args = {
+            'project': regional.project,
+            'regional_dataset': regional.dataset_id,
+            'region': region,
+            'delta': delta_id
+        }
+        layout = hexpop.parse_layout(
+            regional.dataset_id,
+            region,
+            region_codes=[
+                getattr(params, code) for code in ['sem_code', 'bis_code']
+                if hasattr(params, code)
+            ])
+        with hexpop.stage('patch') as patch:
+            if hexpop.bq_query_table(
+                    DELETE_ADDED_REMOVED.format(**format_args)) is None:
+                logger.warning("geopop table for %s not found", region)
+                continue
+            hexpop.bq_query_table(UPDATE_CHANGED.format(**format_args))
+            result = hexpop.bq_query_table(  # added hexes only
+                params.geo_query.format(project=regional.project,
+                                        population=added_view.table_id),
+                '.'.join([regional.project, regional.dataset_id, region]),
+                cluster=layout.cluster)
+            patch.rows = result.total_rows
+        logger.info("patched %s, %d added hexes inserted", region,
+                    result.total_rows)
+        patched.add(region)
+    unpatched = set(hexpop.clean_regions(['all'])) - patched
+    if unpatched:  # views would mix releases across regions
+        logger.error(
+            "geopop.ini and region_stats left at %s, regions %s not "
+            "patched to %s", old, ', '.join(sorted(unpatched)), new)
+        sys.exit(1)
+    switch_release(new)
+    views_dataset = hexpop.bq_prep_dataset('views')
+    coverage_dataset = hexpop.bq_prep_dataset('coverage')
+    hexpop.bq_create_view(views_dataset,
+                          'region_stats',
+                          views.REGION_STATS.format(
+                              project=coverage_dataset.project,
+                              coverage_dataset=coverage_dataset.dataset_id,
+                              population=new),
+                          force_new=True)
+    logger.info("switched geopop.ini and region_stats to %s, %d seconds "
+                "elapsed", new,
+                time.perf_counter() - time_start)
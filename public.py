@@ -71,14 +71,15 @@ def parse_ini(source):
     return config
 
 
-def init_worker():
-    """Name worker and initialize its logger."""
+def init_worker(profile_path=None):
+    """Name worker, initialize its logger and profiling."""
     multiprocessing.current_process().name = pathlib.Path(
         __file__).stem + '_worker' + multiprocessing.current_process(
         ).name.split('-')[-1]
     multiprocessing.current_process().logger = logging.getLogger(
         multiprocessing.current_process().name)
     hexpop.initialize_logging(multiprocessing.current_process().logger)
+    hexpop.initialize_worker_profiling(profile_path)
 
 
 def read_gdf(source, test_rows=0, test_start=0):
@@ -97,6 +98,17 @@ def gdf2df(gdf):
             columns=['geometry'])
 
 
+def recast(temp_table_id, config):
+    """Query recasting temporary table into main table columns."""
+    recast_query = config.recast_query.format(temp_table_id)
+    if config.layout.range_expression:  # derive integer partition column
+        recast_query = (f"SELECT *, {config.layout.range_expression} "
+                        f"AS {config.layout.range_column} "
+                        f"FROM ({recast_query})")
+    return recast_query
+
+
+@hexpop.profiled_task
 def gdf2table(gdf_batch, main_table, config):
     """Load, recast, and append gdf_batch to main_table."""
     logger = multiprocessing.current_process().logger
@@ -117,15 +129,21 @@ def gdf2table(gdf_batch, main_table, config):
     try:
         logger.info("loading dataframe batch to temporary bq table %s",
                     temp_table_id)
-        result = hexpop.bq_load_table(df, temp_table_id, schema=config.schema)
+        with hexpop.stage('batch_load') as batch_load:
+            result = hexpop.bq_load_table(df,
+                                          temp_table_id,
+                                          schema=config.schema)
+            batch_load.rows = result.output_rows
         logger.info("loaded %d rows across %d columns", result.output_rows,
                     len(result.schema))
     except Exception as err:  # unexpected errors can occur with new datasets
         logger.error('EXCEPTION while loading: %s', err)
     try:
-        result = hexpop.bq_query_table(
-            config.recast_query.format(temp_table_id),
-            hexpop.bq_full_id(main_table))
+        with hexpop.stage('batch_recast') as batch_recast:
+            result = hexpop.bq_query_table(recast(temp_table_id, config),
+                                           hexpop.bq_full_id(main_table),
+                                           cluster=config.layout.cluster)
+            batch_recast.rows = df.shape[0]
         logger.info(
             "recast and appended to main bq table %s, currently with %d rows",
             main_table.table_id, result.total_rows)
@@ -143,9 +161,14 @@ if __name__ == '__main__':
     gdlocal = config.gdfile.rsplit('/', maxsplit=1)[-1]
     if os.path.isfile(gdlocal):
         config.gdfile = gdlocal
+    elif config.gdfile.startswith(('http://', 'https://')):
+        with hexpop.stage('download'):
+            config.gdfile = str(hexpop.cached_source(config.gdfile).path)
     gdname = gdlocal.split('.')[0]
     logger.info("reading data %s", config.gdfile)
-    gdf = read_gdf(config.gdfile, test_rows, test_start)
+    with hexpop.stage('read') as read:
+        gdf = read_gdf(config.gdfile, test_rows, test_start)
+        read.rows = gdf.shape[0]
     gdf.drop(columns=config.drop_columns, inplace=True)
     rows = gdf.shape[0]
     logger.info("dataframe %d rows across columns %s", rows,
@@ -168,19 +191,37 @@ if __name__ == '__main__':
             schema_fields.append((column, dtype2sql[dtype.name]))
     config.schema = hexpop.bq_form_schema(schema_fields)
     dataset = hexpop.bq_prep_dataset('public', test_dataset=test_dataset)
-    table = hexpop.bq_create_table(dataset,
-                                   gdname,
-                                   description=config.description,
-                                   force_new=True)
+    config.layout = hexpop.parse_layout('public', gdname)
+    schema_table = hexpop.bq_create_table(  # empty, for recast schema
+        dataset,
+        hexpop.bq_tmp_id(gdname),
+        schema=config.schema,
+        force_new=True)
+    table = hexpop.bq_create_table(
+        dataset,
+        gdname,
+        schema=hexpop.bq_query_schema(
+            recast(hexpop.bq_full_id(schema_table), config)),
+        partition_range=config.layout.partition_range,
+        cluster=config.layout.cluster,
+        description=config.description,
+        force_new=True)
+    hexpop.bq_delete_table(hexpop.bq_full_id(schema_table))
 
     batch_count = max(min(multiprocessing.cpu_count(), rows),
                       math.ceil(rows / 10**6))
     logger.info("dataframe divided into %d batches", batch_count)
-    with multiprocessing.Pool(initializer=init_worker) as p:
-        p.starmap(
-            gdf2table,
-            zip(numpy.array_split(gdf, batch_count), itertools.repeat(table),
-                itertools.repeat(config)))
+    with hexpop.stage('load') as load, multiprocessing.Pool(
+            initializer=init_worker,
+            initargs=(hexpop.worker_profile_path(), )) as p:
+        for _, worker in p.starmap(
+                gdf2table,
+                zip(numpy.array_split(gdf, batch_count),
+                    itertools.repeat(table), itertools.repeat(config))):
+            hexpop.merge_worker_profile(worker)
+        p.close()
+        p.join()  # workers exit normally, flushing queued log records
+        load.rows = gdf.shape[0]
 
     logger.info("completed %s, elapsed time %.2f secods", gdname,
                 time.perf_counter() - time_start)
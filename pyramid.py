@@ -0,0 +1,140 @@
+"""Roll up coverage to coarser H3 resolutions, export choropleth files."""
+import json
+import logging
+import pathlib
+import time
+
+import h3
+import numpy
+import pandas
+
+import coverexp
+import covermap
+import hexarray
+import hexpop
+
+GEOPOP_POPULATION = """
+SELECT h3_index, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions for which to build pyramid')
+    parser.add_argument('-f',
+                        '--formats',
+                        type=str,
+                        nargs='*',
+                        choices=['parquet', 'geojson'],
+                        default=['parquet', 'geojson'],
+                        help='file formats to export per resolution')
+    parser.add_argument('-o',
+                        '--output',
+                        type=pathlib.Path,
+                        default=pathlib.Path('pyramid'),
+                        help='directory for exported files')
+    parser.add_argument('-r',
+                        '--resolutions',
+                        type=int,
+                        nargs='*',
+                        choices=range(9),  # population hexes at 8
+                        default=[8, 7, 6, 5, 4, 3],
+                        metavar='{0..8}',
+                        help='H3 resolutions to export')
+    args = parser.parse_args()
+    return args.regions, args.formats, args.output, args.resolutions
+
+
+def rollup(level, res):
+    """Aggregate pyramid level to parent hexes at coarser resolution."""
+    parents, inverse = numpy.unique(hexarray.to_parent(level['h3_index'], res),
+                                    return_inverse=True)
+    return pandas.DataFrame({
+        'h3_index': parents,
+        **{
+            column: numpy.bincount(inverse, weights=level[column])
+            for column in ['hexes', 'population', 'covered']
+        }
+    })
+
+
+def pyramid(df, resolutions):
+    """Levels of pyramid by resolution, each rolled up from the finer one.
+
+    Sums stay floating point between levels, rounded once per output level;
+    percent is NaN where population is zero.
+    """
+    level = df[['h3_index', 'population', 'covered']].assign(hexes=1)
+    levels = {}
+    for res in sorted(resolutions, reverse=True):
+        level = rollup(level, res)
+        output = level[['h3_index']].assign(
+            **{
+                column: level[column].round().astype('int64')
+                for column in ['hexes', 'population', 'covered']
+            })
+        output['percent'] = (
+            100 * level['covered'] /
+            level['population'].where(level['population'] > 0)).round(1)
+        levels[res] = output
+    return levels
+
+
+def to_geojson(level):
+    """Convert pyramid level to GeoJSON feature collection of hexagons."""
+    features = [{
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [h3.h3_to_geo_boundary(h3_index, geo_json=True)]
+        },
+        'properties': {
+            'h3_index': h3_index,
+            'hexes': int(hexes),
+            'population': int(population),
+            'covered': int(covered),
+            'percent': None if numpy.isnan(percent) else float(percent)
+        }
+    } for h3_index, hexes, population, covered, percent in zip(
+        hexarray.to_strings(level['h3_index']), level['hexes'],
+        level['population'], level['covered'], level['percent'])]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    regions, formats, output, resolutions = parse_args()
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    covered_hexes = (coverexp.query_explorer_coverage()[0]
+                     | covermap.query_mappers_coverage()[0])
+    for region in hexpop.clean_regions(regions):
+        if region == 'gadm':
+            continue
+        df = hexpop.bq_query_table(
+            GEOPOP_POPULATION.format(
+                project=regional_dataset.project,
+                regional_dataset=regional_dataset.dataset_id,
+                region=region)).to_dataframe()
+        df['h3_index'] = hexarray.to_ints(df['h3_index'])
+        df['covered'] = df['population'].where(
+            covered_hexes.contains(df['h3_index']), 0)
+        region_dir = output / region
+        region_dir.mkdir(parents=True, exist_ok=True)
+        for res, level in pyramid(df, resolutions).items():
+            if 'parquet' in formats:
+                level.to_parquet(region_dir / f"res{res}.parquet", index=False)
+            if 'geojson' in formats:
+                with open(region_dir / f"res{res}.geojson", 'w') as geojson:
+                    json.dump(to_geojson(level), geojson)
+            logger.info("%s resolution %d with %d hexes", region, res,
+                        level.shape[0])
+    logger.info("completed, %d seconds elapsed",
+                time.perf_counter() - time_start)
@@ -0,0 +1,157 @@
+"""Recommend hotspot hexes adding most uncovered population, lazy greedy."""
+import heapq
+import logging
+import pathlib
+import sys
+import time
+
+import numpy
+import pandas
+
+import coverexp
+import covermap
+import covermodel
+import geopop
+import hexarray
+import hexpop
+
+GEOPOP_CODES = """
+SELECT h3_index, CAST({sem_code} AS STRING) AS sem_code,
+  CAST({bis_code} AS STRING) AS bis_code, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('region',
+                        type=str,
+                        help='region in which to recommend hotspot hexes')
+    parser.add_argument('-c',
+                        '--code',
+                        type=str,
+                        default=None,
+                        help='limit to subdivision by sem_code or bis_code')
+    parser.add_argument('-m',
+                        '--model',
+                        type=str,
+                        default='adjacent',
+                        help='coverage model from covermodel.ini')
+    parser.add_argument('-n',
+                        '--picks',
+                        type=int,
+                        default=100,
+                        help='number of hotspot hexes to recommend')
+    args = parser.parse_args()
+    return args.region, args.code, args.model, args.picks
+
+
+def neighbor_positions(hexes, ring, neighbors):
+    """Positions of ring neighbors within sorted hexes, -1 if absent."""
+    pos = numpy.minimum(numpy.searchsorted(hexes, neighbors), hexes.size - 1)
+    return numpy.where(hexes[pos] == neighbors, pos, -1)[ring]
+
+
+def lazy_greedy(population, fraction, positions, weights, picks):
+    """Pick hexes maximizing marginal covered population, lazily re-scored.
+
+    Marginal gains only shrink as coverage grows, so a re-scored pick
+    that still tops the heap is the true best.
+    """
+    present = positions >= 0
+    pop = numpy.where(present, population[positions], 0)
+
+    def gains(rows):
+        covered = fraction[positions[rows]]
+        return (pop[rows] *
+                numpy.clip(weights - covered, 0, None)).sum(axis=-1)
+
+    initial = gains(numpy.arange(positions.shape[0]))
+    heap = [(-gain, row) for row, gain in enumerate(initial) if gain > 0]
+    heapq.heapify(heap)
+    selected = []
+    while heap and len(selected) < picks:
+        _, row = heapq.heappop(heap)
+        gain = gains(row)
+        if gain <= 0:
+            continue
+        if heap and gain < -heap[0][0]:
+            heapq.heappush(heap, (-gain, row))  # stale, re-queue
+            continue
+        neighbors = positions[row][present[row]]
+        fraction[neighbors] = numpy.maximum(fraction[neighbors],
+                                            weights[present[row]])
+        selected.append((row, gain))
+    return selected
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    region, code, model_name, picks = parse_args()
+    model = covermodel.parse_ini([model_name])[0]
+    radius = max(len(weights) - 1 for weights in model.weights.values())
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    views_dataset = hexpop.bq_prep_dataset('views')
+    params = geopop.parse_ini(region)
+    result = hexpop.bq_query_table(
+        GEOPOP_CODES.format(project=regional_dataset.project,
+                            regional_dataset=regional_dataset.dataset_id,
+                            region=region,
+                            sem_code=params.sem_code,
+                            bis_code=params.bis_code))
+    if result is None:
+        logger.critical("geopop table for region %s not found", region)
+        sys.exit(1)
+    df = result.to_dataframe()
+    name = region
+    if code:
+        df = df[(df['sem_code'] == code) | (df['bis_code'] == code)]
+        name = f"{region}_{code}"
+    if df.empty:
+        logger.critical("no hexes in region %s%s", region,
+                        f" with sem_code or bis_code {code}" if code else '')
+        sys.exit(1)
+    df['h3_index'] = hexarray.to_ints(df['h3_index'])
+    df = df.sort_values('h3_index', ignore_index=True)
+    hexes = df['h3_index'].to_numpy()
+    hex_sets = {
+        'explorer': coverexp.query_explorer_coverage()[0],
+        'mappers': covermap.query_mappers_coverage()[0]
+    }
+    ring, neighbors, distances = covermodel.cached_ring_index(
+        name, hexes, radius)
+    fraction = covermodel.model_fractions(ring, neighbors, distances,
+                                          hex_sets, [model])[model.name]
+    explorer_weights = numpy.array(model.weights['explorer'] + [0] * radius)
+    population = df['population'].to_numpy()
+    logger.info("%s %d hexes, %d pops, %.1f%% covered under model %s", name,
+                hexes.size, population.sum(),
+                100 * (population * fraction).sum() / population.sum(),
+                model.name)
+    selected = lazy_greedy(population, fraction,
+                           neighbor_positions(hexes, ring, neighbors),
+                           explorer_weights[distances], picks)
+    rows = [row for row, _ in selected]
+    df_picks = pandas.DataFrame({
+        'rank': numpy.arange(1, len(selected) + 1),
+        'h3_index': hexarray.to_strings(hexes[rows]),
+        'sem_code': df['sem_code'].to_numpy()[rows],
+        'bis_code': df['bis_code'].to_numpy()[rows],
+        'marginal_gain': numpy.array([g for _, g in selected]).round()
+    })
+    df_picks['cumulative_gain'] = df_picks['marginal_gain'].cumsum()
+    df_picks['model'] = model.name
+    for pick in df_picks.head(10).itertuples():
+        logger.info("%d %s adds %d pops", pick.rank, pick.h3_index,
+                    pick.marginal_gain)
+    table_id = '.'.join(
+        [views_dataset.project, views_dataset.dataset_id, f"recommend_{name}"])
+    hexpop.bq_load_table(df_picks, table_id, write='WRITE_TRUNCATE')
+    logger.info("%d picks add %d pops (%.1f%%) to %s, %d seconds elapsed",
+                df_picks.shape[0], df_picks['marginal_gain'].sum(),
+                100 * df_picks['marginal_gain'].sum() / population.sum(),
+                table_id,
+                time.perf_counter() - time_start)
@@ -1,55 +1,80 @@
 """Convert Statoids webpage to dataframe, load table."""
+import io
+import itertools
 import logging
 import pathlib
 
 import pandas
-import requests
 from bs4 import BeautifulSoup
 
 import hexpop
 
+STATOIDS_URL = 'http://www.statoids.com/yus.html'
 INT_FIELDS = ['Pop_2010', 'Area_mi', 'Area_km']
 
 
-def string2fields(string, lengths):
-    """Slice string into fixed-length fields."""
-    return (string[pos:pos + length].strip()
-            for idx, length in enumerate(lengths)
-            for pos in [sum(map(int, lengths[:idx]))])
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.parse_args()
 
 
-def usa_counties():
-    """Scrape webpage, return dataframe."""
-    table = BeautifulSoup(
-        requests.get('http://www.statoids.com/yus.html').text,
-        'html.parser').pre.string.split('\r\n')
+def column_specs(widths):
+    """Start and end offsets of fixed-width fields."""
+    ends = list(itertools.accumulate(widths))
+    return list(zip([0] + ends[:-1], ends))
+
+
+def parse_counties(html):
+    """Parse fixed-width table of webpage, return dataframe."""
+    table = BeautifulSoup(html, 'html.parser').pre.string.splitlines()
     column_lines = table[2]
     column_widths = [len(column) + 1 for column in column_lines.split(' ')]
     column_widths[-1] = 99
+    colspecs = column_specs(column_widths)
     column_names = table[1]
     keys = [
-        field.replace('-', '_').replace('2010 pop.', 'Pop_2010')
-        for field in list(string2fields(column_names, column_widths))
+        column_names[start:end].strip().replace('-', '_').replace(
+            '2010 pop.', 'Pop_2010') for start, end in colspecs
+    ]
+    lines = [
+        line for line in table
+        if line.strip() not in ['', column_names, column_lines]
     ]
-    data_dict_list = []
-    for line in table:
-        if line.strip() in ['', column_names, column_lines]:
-            continue
-        data_dict = {}
-        for key, field in zip(keys, list(string2fields(line, column_widths))):
-            data_dict[key] = field.replace(',', '')  # no comma in numbers
-        data_dict_list += [data_dict]
-    df = pandas.DataFrame(data_dict_list)
+    df = pandas.read_fwf(io.StringIO('\n'.join(lines)),
+                         colspecs=colspecs,
+                         names=keys,
+                         dtype=str,
+                         keep_default_na=False)
+    df = df.replace(',', '', regex=True)  # no comma in numbers
     for col in INT_FIELDS:
         df[col] = pandas.to_numeric(df[col])
     return df
 
 
+def usa_counties():
+    """Fetch webpage if changed, return dataframe parsed once per content."""
+    source = hexpop.cached_source(STATOIDS_URL)
+    parsed_path = hexpop.CACHE_DIR / f"statoids_{source.sha256[:12]}.pkl"
+    if parsed_path.exists():
+        hexpop.count('statoids_parse_cached')
+        return pandas.read_pickle(parsed_path)
+    df = parse_counties(source.path.read_bytes())
+    for stale_path in hexpop.CACHE_DIR.glob('statoids_*.pkl'):
+        stale_path.unlink()
+    df.to_pickle(parsed_path)
+    return df
+
+
 if __name__ == '__main__':
     logger = logging.getLogger(pathlib.Path(__file__).stem)
     hexpop.initialize_logging(logger)
-    counties_df = usa_counties()
-    logger.debug(counties_df)
+    parse_args()
+    with hexpop.stage('scrape') as scrape:
+        counties_df = usa_counties()
+        scrape.rows = counties_df.shape[0]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(counties_df)
     dataset = hexpop.bq_prep_dataset('public')
     table_id = table_id = '.'.join(
         [dataset.project, dataset.dataset_id, 'statoids_usa_counties'])
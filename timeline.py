@@ -0,0 +1,220 @@
+"""Sweep coverage update history to tabulate population covered over time."""
+import datetime
+import logging
+import pathlib
+import time
+
+import numpy
+import pandas
+
+import geopop
+import hexarray
+import hexpop
+
+REGION_HEXES = """
+SELECT h3_index FROM `{project}.{regional_dataset}.{region}`
+"""
+
+MAPPERS_HISTORY = """
+SELECT h3_index, mappers_coverage AS coverage, update_time
+FROM `{project}.{coverage_dataset}.mappers_updates`
+WHERE update_time < TIMESTAMP('{end}')
+AND h3_index IN ({region_hexes})
+"""
+
+EXPLORER_HISTORY = """
+SELECT h3_index, update_time
+FROM `{project}.{coverage_dataset}.explorer_updates`
+WHERE update_time < TIMESTAMP('{end}') AND explorer_coverage
+AND h3_index IN ({region_hexes})
+"""
+
+EXPLORER_SNAPSHOTS = """
+SELECT DISTINCT update_time
+FROM `{project}.{coverage_dataset}.explorer_updates`
+WHERE update_time < TIMESTAMP('{end}')
+ORDER BY update_time
+"""
+
+GEOPOP_BY_LEVEL = """
+SELECT h3_index, CAST({code} AS STRING) AS code, population
+FROM `{project}.{regional_dataset}.{region}`
+"""
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('regions',
+                        type=str,
+                        nargs='*',
+                        default='all',
+                        help='regions for which to tabulate coverage')
+    today = datetime.datetime.utcnow().date()
+    parser.add_argument('-s',
+                        '--start',
+                        type=datetime.date.fromisoformat,
+                        default=today - datetime.timedelta(days=90),
+                        help='first date of timeline')
+    parser.add_argument('-e',
+                        '--end',
+                        type=datetime.date.fromisoformat,
+                        default=today,
+                        help='last date of timeline')
+    parser.add_argument('-f',
+                        '--frequency',
+                        type=str,
+                        choices=['D', 'H'],
+                        default='D',
+                        help='daily or hourly periods')
+    parser.add_argument('-l',
+                        '--level',
+                        type=str,
+                        choices=['sem', 'bis'],
+                        default='sem',
+                        help='subdivision level within region')
+    args = parser.parse_args()
+    return (args.regions, args.start, args.end, args.frequency, args.level)
+
+
+def mappers_changes(df):
+    """Reduce Mappers updates to changes of coverage state per hex."""
+    df = df.sort_values(['h3_index', 'update_time'], kind='stable')
+    previous = df.groupby('h3_index')['coverage'].shift(fill_value=False)
+    return df[df['coverage'] != previous].assign(source='mappers')
+
+
+def explorer_changes(df, snapshots):
+    """Convert Explorer snapshots to appear and disappear events per hex."""
+    snap = numpy.searchsorted(snapshots, df['update_time'].to_numpy())
+    df = df.assign(snap=snap).sort_values(['h3_index', 'snap'],
+                                          kind='stable')
+    same_hex = df['h3_index'].to_numpy()[1:] == df['h3_index'].to_numpy()[:-1]
+    snap = df['snap'].to_numpy()
+    consecutive = numpy.zeros(snap.size, dtype=bool)
+    consecutive[1:] = same_hex & (snap[1:] == snap[:-1] + 1)
+    continued = numpy.zeros(snap.size, dtype=bool)
+    continued[:-1] = consecutive[1:]
+    appear = df[~consecutive].assign(coverage=True)
+    disappear = df[~continued & (snap + 1 < len(snapshots))]
+    disappear = disappear.assign(
+        coverage=False,
+        update_time=snapshots[disappear['snap'].to_numpy() + 1])
+    return pandas.concat([appear, disappear]).drop(
+        columns=['snap']).assign(source='explorer')
+
+
+def coverage_changes(mappers, explorer):
+    """Combine per-source changes into changes of covered state per hex."""
+    events = pandas.concat([mappers, explorer], ignore_index=True)
+    events = events.sort_values(['h3_index', 'update_time'], kind='stable')
+    for source in ['mappers', 'explorer']:
+        state = events['coverage'].where(events['source'] == source)
+        events[source] = state.groupby(
+            events['h3_index']).ffill().fillna(False).astype(bool)
+    covered = events['mappers'] | events['explorer']
+    previous = covered.groupby(events['h3_index']).shift(fill_value=False)
+    events['delta'] = covered.astype(numpy.int8) - previous.astype(numpy.int8)
+    return events.loc[events['delta'] != 0,
+                      ['h3_index', 'update_time', 'delta']]
+
+
+def sweep(changes, df_geopop, periods):
+    """Accumulate population deltas into covered totals per period."""
+    df_geopop = df_geopop.sort_values('h3_index')
+    geopop_hexes = df_geopop['h3_index'].to_numpy()
+    pos = numpy.minimum(
+        numpy.searchsorted(geopop_hexes, changes['h3_index'].to_numpy()),
+        geopop_hexes.size - 1)
+    found = geopop_hexes[pos] == changes['h3_index'].to_numpy()
+    pos = pos[found]
+    period = numpy.maximum(
+        numpy.searchsorted(periods.to_numpy(),
+                           changes['update_time'].to_numpy()[found],
+                           side='right') - 1, 0)  # before start into first
+    deltas = pandas.DataFrame({
+        'period': periods[period],
+        'code': df_geopop['code'].to_numpy()[pos],
+        'covered': changes['delta'].to_numpy()[found] *
+        df_geopop['population'].to_numpy()[pos]
+    })
+    deltas = pandas.concat([deltas, deltas.assign(code='total')])
+    totals = df_geopop.groupby('code')['population'].sum()
+    totals['total'] = df_geopop['population'].sum()
+    covered = deltas.pivot_table(index='period',
+                                 columns='code',
+                                 values='covered',
+                                 aggfunc='sum').reindex(
+                                     index=periods,
+                                     columns=totals.index).fillna(0)
+    covered.index.name = 'period'
+    covered = covered.cumsum().astype('int64').stack().rename(
+        'covered').reset_index()
+    covered['total'] = covered['code'].map(totals)
+    covered['percent'] = (100 * covered['covered'] /
+                          covered['total']).round(1)
+    return covered
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    regions, start, end, frequency, level = parse_args()
+    time_start = time.perf_counter()
+    regional_dataset = hexpop.bq_prep_dataset('geopop')
+    coverage_dataset = hexpop.bq_prep_dataset('coverage')
+    views_dataset = hexpop.bq_prep_dataset('views')
+    regions = [r for r in hexpop.clean_regions(regions) if r != 'gadm']
+    end_time = datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                         datetime.time())
+    periods = pandas.date_range(start,
+                                end_time,
+                                freq=frequency,
+                                inclusive='left')
+    format_args = {
+        'project': coverage_dataset.project,
+        'coverage_dataset': coverage_dataset.dataset_id,
+        'end': end_time.isoformat(),
+        'region_hexes': ' UNION ALL '.join(
+            REGION_HEXES.format(project=regional_dataset.project,
+                                regional_dataset=regional_dataset.dataset_id,
+                                region=region) for region in regions)
+    }
+    df_mappers = hexpop.bq_query_table(
+        MAPPERS_HISTORY.format(**format_args)).to_dataframe()
+    df_explorer = hexpop.bq_query_table(
+        EXPLORER_HISTORY.format(**format_args)).to_dataframe()
+    snapshots = hexpop.bq_query_table(
+        EXPLORER_SNAPSHOTS.format(**format_args)).to_dataframe()
+    logger.info("read %d mappers updates, %d explorer updates in %d snapshots",
+                df_mappers.shape[0], df_explorer.shape[0], snapshots.shape[0])
+    for df in [df_mappers, df_explorer, snapshots]:
+        df['update_time'] = df['update_time'].dt.tz_convert(None)  # UTC
+    for df in [df_mappers, df_explorer]:
+        df['h3_index'] = hexarray.to_ints(df['h3_index'])
+    changes = coverage_changes(
+        mappers_changes(df_mappers),
+        explorer_changes(df_explorer, snapshots['update_time'].to_numpy()))
+    logger.info("%d changes of covered state, %d seconds elapsed",
+                changes.shape[0],
+                time.perf_counter() - time_start)
+    for region in regions:
+        params = geopop.parse_ini(region)
+        df_geopop = hexpop.bq_query_table(
+            GEOPOP_BY_LEVEL.format(
+                project=regional_dataset.project,
+                regional_dataset=regional_dataset.dataset_id,
+                region=region,
+                code=getattr(params, f"{level}_code"))).to_dataframe()
+        df_geopop['h3_index'] = hexarray.to_ints(df_geopop['h3_index'])
+        df_timeline = sweep(changes, df_geopop, periods)
+        table_id = '.'.join(
+            [views_dataset.project, views_dataset.dataset_id,
+             f"timeline_{region}"])
+        hexpop.bq_load_table(df_timeline, table_id, write='WRITE_TRUNCATE')
+        latest = df_timeline[(df_timeline['code'] == 'total')].iloc[-1]
+        logger.info("%s %d rows to %s, %.1f%% covered at %s", region,
+                    df_timeline.shape[0], table_id, latest['percent'],
+                    latest['period'])
+    logger.info("completed %d regions, %d seconds elapsed", len(regions),
+                time.perf_counter() - time_start)
@@ -1,15 +1,32 @@
-"""Creates mask and plots map of USA lower 48 states."""
-import geopandas
+"""Plots map of USA lower 48 states from precomputed hex mask."""
+import h3
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
 
-USA48_LIST = """
-AL,AR,AZ,CA,CO,CT,DC,DE,FL,GA,IA,ID,IL,IN,KS,KY,LA,MA,MD,ME,MI,MN,MO,MS,MT,\
-NC,ND,NE,NH,NJ,NM,NV,NY,OH,OK,OR,PA,RI,SC,SD,TN,TX,UT,VA,VT,WA,WI,WV,WY
-"""
-print(USA48_LIST)
-
-world = geopandas.read_file(geopandas.datasets.get_path('naturalearth_lowres'))
-usa = world[world['name'] == 'United States of America']
-usa48 = usa.explode(ignore_index=True).drop(range(1, 10))  # drop AK and HI
-usa48.plot()
-plt.show()
+import hexarray
+import hexpop
+import masks
+
+USA48_LIST = ','.join(masks.parse_ini('usa48').codes)
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.parse_args()
+
+
+if __name__ == '__main__':
+    parse_args()
+    print(USA48_LIST)
+    usa48 = masks.load_mask('usa48')  # build first with: masks.py usa48
+    print(usa48)
+    polygons = [
+        h3.h3_to_geo_boundary(cell, geo_json=True)
+        for cell in hexarray.to_strings(usa48.cells())
+    ]
+    _, ax = plt.subplots()
+    ax.add_collection(PolyCollection(polygons, linewidths=0))
+    ax.autoscale()
+    ax.set_aspect('equal')
+    plt.show()
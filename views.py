@@ -1,11 +1,14 @@
 """Create dynamic views of population coverage percentage by region levels."""
 import logging
 import pathlib
+import sys
+from types import SimpleNamespace
 
 import coverexp
 import covermap
 import geopop
 import hexpop
+import localbq
 
 MOST_RECENT = """
 WITH most_recent AS (SELECT
@@ -63,7 +66,7 @@ FROM (
       THEN pop.population ELSE 0 END) AS pop_cover
   FROM (
     SELECT * FROM `{project}.{coverage_dataset}.most_recent`) AS cover
-    LEFT JOIN `{project}.public.kontur_population_20211109` AS pop
+    LEFT JOIN `{project}.public.{population}` AS pop
     ON cover.h3_index = pop.h3_index
   GROUP BY
     ROLLUP (cover.region) )
@@ -203,67 +206,100 @@ def _geom_add(include):
     return '/*', '*/', None
 
 
-if __name__ == '__main__':
-    logger = logging.getLogger(pathlib.Path(__file__).stem)
-    hexpop.initialize_logging(logger)
-    geopop_dataset = hexpop.bq_prep_dataset('geopop')
-    coverage_dataset = hexpop.bq_prep_dataset('coverage')
-    views_dataset = hexpop.bq_prep_dataset('views')
+def parse_args():
+    """Parse command line arguments."""
+    parser = hexpop.initialize_parser(__doc__)
+    parser.add_argument('-d',
+                        '--dry_run',
+                        action='store_true',
+                        default=False,
+                        help='estimate bytes each view would scan, '
+                        'do not create views')
+    args = parser.parse_args()
+    return args.dry_run
 
-    logger.info("most_recent_explorer")
-    coverexp.query_explorer_coverage()
-    logger.info("most_recent_mappers")
-    covermap.query_mappers_coverage()
 
-    view_id = 'most_recent'
+def create_view(dataset, view_id, query, dry_run=False, estimates=None):
+    """Create view, or estimate bytes its query would scan into estimates."""
+    from google.api_core.exceptions import BadRequest, NotFound
+    logger = logging.getLogger(f"{__name__}.{sys._getframe().f_code.co_name}")
+    hexpop.initialize_logging(logger)
     logger.info(view_id)
-    region_stats = hexpop.bq_create_view(
-        coverage_dataset,
-        view_id,
-        MOST_RECENT.format(project=coverage_dataset.project,
-                           coverage_dataset=coverage_dataset.dataset_id,
-                           regional_dataset=geopop_dataset.dataset_id),
-        force_new=True)
+    if estimates is None:
+        estimates = {}
+    if not dry_run:
+        with hexpop.stage('create_view'):
+            return hexpop.bq_create_view(dataset,
+                                         view_id,
+                                         query,
+                                         force_new=True)
+    try:  # dependent views must already exist from a previous run
+        estimates[view_id] = hexpop.bq_estimate_query(query)
+    except (BadRequest, NotFound) as err:
+        logger.warning("%s not estimated: %s", view_id, err)
+        return None
+    logger.info("%s would scan %.3f GB", view_id, estimates[view_id] / 10**9)
+    return None
 
-    view_id = 'covered_hexes'
-    logger.info(view_id)
-    region_stats = hexpop.bq_create_view(
-        views_dataset,
-        view_id,
-        COVERED_HEXES.format(project=coverage_dataset.project,
-                             coverage_dataset=coverage_dataset.dataset_id),
-        force_new=True)
 
-    view_id = 'region_stats'
-    logger.info(view_id)
-    region_stats = hexpop.bq_create_view(
-        views_dataset,
-        view_id,
-        REGION_STATS.format(project=coverage_dataset.project,
-                            coverage_dataset=coverage_dataset.dataset_id),
-        force_new=True)
+def view_specs(geopop_dataset, coverage_dataset, views_dataset, regions):
+    """Dataset, view_id and query of each view, dependencies first."""
+    specs = [
+        SimpleNamespace(dataset=coverage_dataset,
+                        view_id='most_recent_explorer',
+                        query=coverexp.MOST_RECENT_EXPLORER_UPDATES.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id)),
+        SimpleNamespace(dataset=coverage_dataset,
+                        view_id='most_recent_mappers',
+                        query=covermap.MOST_RECENT_MAPPERS_UPDATES.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id)),
+        SimpleNamespace(dataset=coverage_dataset,
+                        view_id='most_recent_children',
+                        query=covermap.MOST_RECENT_MAPPERS_CHILDREN.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id)),
+        SimpleNamespace(dataset=coverage_dataset,
+                        view_id='most_recent',
+                        query=MOST_RECENT.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id,
+                            regional_dataset=geopop_dataset.dataset_id)),
+        SimpleNamespace(dataset=views_dataset,
+                        view_id='covered_hexes',
+                        query=COVERED_HEXES.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id)),
+        SimpleNamespace(dataset=views_dataset,
+                        view_id='region_stats',
+                        query=REGION_STATS.format(
+                            project=coverage_dataset.project,
+                            coverage_dataset=coverage_dataset.dataset_id,
+                            population=geopop.population_table()))
+    ]
 
-    for region in hexpop.clean_regions('all'):
+    for region in regions:
         if region == 'gadm':
             continue
         params = geopop.parse_ini(region)
         view_id = _create_id(
             [geopop_dataset.dataset_id, coverage_dataset.dataset_id, region])
-        logger.info(view_id)
         query = GEOPOP_COVERAGE_BY_REGION.format(
             project=coverage_dataset.project,
             coverage_dataset=coverage_dataset.dataset_id,
             regional_dataset=geopop_dataset.dataset_id,
             region=region,
             bis_code=params.bis_code)
-        hexpop.bq_create_view(views_dataset, view_id, query, force_new=True)
+        specs.append(SimpleNamespace(dataset=views_dataset,
+                                     view_id=view_id,
+                                     query=query))
 
         geoignore_start, geoignore_stop, geo_suffix = _geom_add(
             params.sem_geom_include)
         view_id = _create_id(
             ['div1', region, 'by',
              params.sem_admin.replace(' ', '_')], geo_suffix)
-        logger.info(view_id)
         query = SUMMARY_BY_SEM.format(project=geopop_dataset.project,
                                       views_dataset=views_dataset.dataset_id,
                                       region=region,
@@ -275,14 +311,15 @@ if __name__ == '__main__':
                                       geoignore_stop=geoignore_stop,
                                       sem_source=params.sem_source.format(
                                           project=geopop_dataset.project))
-        hexpop.bq_create_view(views_dataset, view_id, query, force_new=True)
+        specs.append(SimpleNamespace(dataset=views_dataset,
+                                     view_id=view_id,
+                                     query=query))
 
         geoignore_start, geoignore_stop, geo_suffix = _geom_add(
             params.bis_geom_include)
         view_id = _create_id(
             ['div2', region, 'by',
              params.bis_admin.replace(' ', '_')], geo_suffix)
-        logger.info(view_id)
         query = SUMMARY_BY_BIS.format(project=geopop_dataset.project,
                                       views_dataset=views_dataset.dataset_id,
                                       region=region,
@@ -298,18 +335,50 @@ if __name__ == '__main__':
                                       geoignore_stop=geoignore_stop,
                                       bis_source=params.bis_source.format(
                                           project=geopop_dataset.project))
-        hexpop.bq_create_view(views_dataset, view_id, query, force_new=True)
+        specs.append(SimpleNamespace(dataset=views_dataset,
+                                     view_id=view_id,
+                                     query=query))
 
-    view_id = 'div1_usa_canada_by_state_province'
-    logger.info(view_id)
     query = SUMMARY_COMBO_USA_CANADA.format(
         project=views_dataset.project, views_dataset=views_dataset.dataset_id)
-    hexpop.bq_create_view(views_dataset, view_id, query, force_new=True)
+    specs.append(SimpleNamespace(dataset=views_dataset,
+                                 view_id='div1_usa_canada_by_state_province',
+                                 query=query))
 
-    view_id = 'div0_global_by_country'
-    logger.info(view_id)
     query = SUMMARY_BY_COUNTRY.format(
         project=geopop_dataset.project,
         views_dataset=views_dataset.dataset_id,
     )
-    hexpop.bq_create_view(views_dataset, view_id, query, force_new=True)
+    specs.append(SimpleNamespace(dataset=views_dataset,
+                                 view_id='div0_global_by_country',
+                                 query=query))
+    return specs
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger(pathlib.Path(__file__).stem)
+    hexpop.initialize_logging(logger)
+    dry_run = parse_args()
+    estimates = {}
+    geopop_dataset = hexpop.bq_prep_dataset('geopop')
+    coverage_dataset = hexpop.bq_prep_dataset('coverage')
+    views_dataset = hexpop.bq_prep_dataset('views')
+
+    for spec in view_specs(geopop_dataset, coverage_dataset, views_dataset,
+                           hexpop.clean_regions('all')):
+        if (hexpop.backend().engine == 'duckdb'
+                and localbq.unsupported(spec.query)):
+            logger.warning("skipping view %s, %s not supported locally",
+                           spec.view_id,
+                           ', '.join(localbq.unsupported(spec.query)))
+            continue
+        create_view(spec.dataset, spec.view_id, spec.query, dry_run,
+                    estimates)
+
+    if dry_run:
+        for view_id, scanned in sorted(estimates.items(),
+                                       key=lambda x: x[1],
+                                       reverse=True):
+            logger.info("%-48s %10.3f GB", view_id, scanned / 10**9)
+        logger.info("%-48s %10.3f GB", 'total',
+                    sum(estimates.values()) / 10**9)